@@ -0,0 +1,253 @@
+"""Benchmark offline cho bot key: chạy logic lệnh trên GitHub Contents API giả lập.
+
+Không cần DISCORD_TOKEN/GITHUB_TOKEN. Ví dụ:
+    python benchmark.py
+    python benchmark.py --sizes 1000,10000,100000,1000000 --latency 80 --conflict-rate 0.1
+"""
+import argparse
+import asyncio
+import base64
+import datetime
+import hashlib
+import os
+import random
+import statistics
+import time
+
+from aiohttp import web
+
+FAKE_HOST = '127.0.0.1'
+FAKE_PORT = int(os.getenv('BENCH_GITHUB_PORT', '8799'))
+
+# Phải set trước khi import main để backend trỏ vào GitHub giả
+os.environ['GITHUB_API_URL'] = f"http://{FAKE_HOST}:{FAKE_PORT}"
+os.environ.setdefault('GITHUB_TOKEN', 'benchmark')
+# Mặc định không gom lô để thời gian commit không bị cửa sổ 0.5s che mất (set env để đo như production)
+os.environ.setdefault('COMMIT_BATCH_WINDOW', '0')
+
+import main  # noqa: E402
+
+# ===============================
+# 🐙 GITHUB GIẢ LẬP
+# ===============================
+
+class FakeGitHub:
+    """Contents API giả trong cùng tiến trình: ETag/304, kiểm tra sha, file > 1MB trả bản raw.
+
+    latency: độ trễ (giây) mỗi request; conflict_rate: xác suất PUT bị trả 409.
+    """
+    RAW_LIMIT = 1024 * 1024
+
+    def __init__(self, latency=0.0, conflict_rate=0.0):
+        self.latency = latency
+        self.conflict_rate = conflict_rate
+        self.files = {}
+        self.requests = 0
+        self.conflicts = 0
+        self._runner = None
+
+    @staticmethod
+    def sha(content):
+        return hashlib.sha1(content).hexdigest()
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_get('/repos/{owner}/{repo}/contents/{path:.*}', self.get)
+        app.router.add_put('/repos/{owner}/{repo}/contents/{path:.*}', self.put)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, FAKE_HOST, FAKE_PORT).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def get(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        path = request.match_info['path']
+        if path not in self.files:
+            return web.json_response({'message': 'Not Found'}, status=404)
+
+        content = self.files[path]
+        sha = self.sha(content)
+        etag = f'"{sha}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        if request.headers.get('Accept') == 'application/vnd.github.raw':
+            return web.Response(body=content, headers={'ETag': etag})
+        if len(content) > self.RAW_LIMIT:
+            return web.json_response({'sha': sha, 'encoding': 'none', 'content': ''}, headers={'ETag': etag})
+        return web.json_response(
+            {'sha': sha, 'encoding': 'base64', 'content': base64.b64encode(content).decode()},
+            headers={'ETag': etag},
+        )
+
+    async def put(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        path = request.match_info['path']
+        payload = await request.json()
+        current = self.files.get(path)
+        current_sha = self.sha(current) if current is not None else None
+
+        if payload.get('sha') != current_sha or random.random() < self.conflict_rate:
+            self.conflicts += 1
+            return web.json_response({'message': 'sha does not match'}, status=409)
+
+        content = base64.b64decode(payload['content'])
+        self.files[path] = content
+        return web.json_response({'content': {'sha': self.sha(content)}}, status=200 if current is not None else 201)
+
+# ===============================
+# 🔑 DỮ LIỆU GIẢ
+# ===============================
+
+# Chỉ dùng generate_keys, không chạm tới backend
+key_generator = main.KeyManager(main.KeyBackend())
+
+def synthetic_keys(count, seed=0):
+    """Tạo count key: 1/3 mỗi loại, ~30% đã kích hoạt, ~10% đã hết hạn"""
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    keys = []
+    for i, key in enumerate(key_generator.generate_keys(count)):
+        key_type = ('single', 'multi', 'unlimited')[i % 3]
+        key_obj = {
+            "key": key,
+            "hwid": f"HWID-{rng.randrange(10 ** 8):08d}" if rng.random() < 0.3 else "",
+            "type": key_type,
+            "expires": None if key_type == 'unlimited' else (now + datetime.timedelta(days=rng.uniform(-6, 54))).isoformat(),
+        }
+        if key_type == 'unlimited':
+            key_obj["unlimited"] = True
+        keys.append(key_obj)
+    return keys
+
+# ===============================
+# ⏱️ ĐO VÀ BÁO CÁO
+# ===============================
+
+class Report:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, scenario, size, ops, samples):
+        """samples: thời gian (giây) từng lần chạy, mỗi lần xử lý ops/len(samples) thao tác"""
+        total = sum(samples)
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+        self.rows.append((scenario, size, ops, total, ops / total if total else float('inf'),
+                          statistics.median(ordered) * 1000, p95 * 1000))
+        print(f"  {scenario:<22} {ops:>9} ops  {ops / total if total else 0:>12,.0f} ops/s  "
+              f"p50 {statistics.median(ordered) * 1000:>9.3f} ms  p95 {p95 * 1000:>9.3f} ms")
+
+    def print_table(self):
+        print()
+        print(f"{'Kịch bản':<22} {'Số key':>9} {'Ops':>9} {'Tổng (s)':>10} {'Ops/s':>14} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+        print('-' * 90)
+        for scenario, size, ops, total, rate, p50, p95 in self.rows:
+            print(f"{scenario:<22} {size:>9} {ops:>9} {total:>10.3f} {rate:>14,.0f} {p50:>10.3f} {p95:>10.3f}")
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+async def atimed(coro):
+    started = time.perf_counter()
+    result = await coro
+    return time.perf_counter() - started, result
+
+# ===============================
+# 🚀 CÁC KỊCH BẢN
+# ===============================
+
+async def bench_size(size, args, report):
+    print(f"\n📦 {size:,} keys")
+    keys = synthetic_keys(size)
+    rng = random.Random(size)
+
+    # Tạo key
+    samples = [timed(key_generator.generate_keys, max(1, size // 10))[0] for _ in range(args.rounds)]
+    report.add('generate', size, max(1, size // 10) * args.rounds, samples)
+
+    # Parse / serialize file key (giống GitHubJsonBackend._fetch_snapshot và _encode)
+    blob = main.dumps_json(keys, not main.JSON_COMPACT)
+    samples, store = [], None
+    for _ in range(args.rounds):
+        elapsed, store = timed(lambda: main.KeyStore(main.loads_json(blob)))
+        samples.append(elapsed)
+    report.add('parse+index', size, size * args.rounds, samples)
+    samples = [timed(lambda: main.dumps_json(store.to_list(), not main.JSON_COMPACT))[0] for _ in range(args.rounds)]
+    report.add('serialize', size, size * args.rounds, samples)
+
+    # Tra cứu trong bộ nhớ
+    probes = [keys[rng.randrange(size)]['key'] for _ in range(args.lookups)]
+    samples = []
+    for key in probes:
+        started = time.perf_counter()
+        store.get(key)
+        samples.append(time.perf_counter() - started)
+    report.add('lookup', size, len(probes), samples)
+
+    # Thống kê
+    samples = [timed(store.stats)[0] for _ in range(args.lookups // 10 or 1)]
+    report.add('stats', size, len(samples), samples)
+
+    # Tìm theo tiền tố (index sắp xếp)
+    samples = [timed(lambda prefix=key[:8]: store.query(prefix=prefix))[0] for key in probes[:args.lookups // 10 or 1]]
+    report.add('prefix search', size, len(samples), samples)
+
+    # End-to-end qua GitHub giả: nạp, verify, xóa hàng loạt, quét key hết hạn
+    fake = FakeGitHub(latency=args.latency / 1000, conflict_rate=args.conflict_rate)
+    fake.files[main.JSON_FILE_PATH] = blob
+    await fake.start()
+    manager = main.KeyManager(main.GitHubJsonBackend(main.GITHUB_TOKEN, 'bench/keys'))
+    try:
+        elapsed, _ = await atimed(manager.warm_up())
+        report.add('cold load (github)', size, 1, [elapsed])
+
+        samples = []
+        for key in probes:
+            elapsed, _ = await atimed(manager.verify(key))
+            samples.append(elapsed)
+        report.add('verify', size, len(probes), samples)
+
+        samples = []
+        for _ in range(args.rounds):
+            current = await manager.get_cached_json()
+            victims = rng.sample([k['key'] for k in current], min(len(current), max(1, size // 100)))
+            elapsed, _ = await atimed(manager.submit(lambda store, victims=victims: store.remove_many(victims), keys=victims))
+            samples.append(elapsed)
+        report.add('bulk delete 1%', size, len(samples), samples)
+
+        current = await manager.get_cached_json()
+        expired_keys = current.expired()
+        elapsed, removed = await atimed(manager.remove_expired(expired_keys))
+        report.add('expiry sweep', size, max(1, removed), [elapsed])
+
+        print(f"  🐙 {fake.requests} request GitHub giả, {fake.conflicts} lần 409")
+    finally:
+        await manager.close()
+        await fake.stop()
+
+async def run(args):
+    report = Report()
+    for size in args.sizes:
+        await bench_size(size, args, report)
+    report.print_table()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline cho bot key")
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        type=lambda value: [int(x) for x in value.split(',')],
+                        help="Số key cần thử, phân cách bằng dấu phẩy (vd 1000,10000,1000000)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Độ trễ mỗi request GitHub giả (ms)")
+    parser.add_argument('--conflict-rate', type=float, default=0.0, help="Xác suất PUT bị 409 (0-1)")
+    parser.add_argument('--rounds', type=int, default=3, help="Số lần lặp cho mỗi kịch bản")
+    parser.add_argument('--lookups', type=int, default=10000, help="Số lần tra cứu key")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
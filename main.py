@@ -1,13 +1,40 @@
 import discord
+from discord import app_commands
 from discord.ext import commands
 import aiohttp
+from aiohttp import web
 import asyncio
 import json
-import random
+import secrets
 import string
 import datetime
-from github import Github
+import base64
+import io
+import csv
+import re
+import hashlib
+import hmac
+import time
 import os
+import socket
+import sqlite3
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict, OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from bisect import bisect_left, bisect_right, insort
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # ===============================
 # 🚀 CONFIG CHO RAILWAY
@@ -19,70 +46,2877 @@ DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')
 GITHUB_REPO = os.getenv('GITHUB_REPO', 'cacdai1234/AIMBOTLOAD-APIKEY')
 JSON_FILE_PATH = os.getenv('JSON_FILE_PATH', 'auth-data.json')
-ADMIN_IDS = [int(x.strip()) for x in os.getenv('ADMIN_IDS', '1395096403017072660,1395096403017072660').split(',')]
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'github').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'keys.db')
+# ADMIN_IDS chỉ dùng lần đầu; sau đó danh sách admin được lưu trong backend (ADMINS_FILE_PATH hoặc bảng admins)
+ADMIN_IDS = frozenset(int(x.strip()) for x in os.getenv('ADMIN_IDS', '1395096403017072660,1395096403017072660').split(','))
+ADMINS_FILE_PATH = os.getenv('ADMINS_FILE_PATH', 'admins.json')
+
+def check_env():
+    """Kiểm tra biến môi trường trước khi chạy bot (không chạy khi import, để benchmark dùng được)"""
+    if not DISCORD_TOKEN:
+        print("❌ LỖI: DISCORD_TOKEN không được tìm thấy!")
+        return False
+    
+    if STORAGE_BACKEND not in ('github', 'sqlite'):
+        print(f"❌ LỖI: STORAGE_BACKEND không hợp lệ: {STORAGE_BACKEND} (chọn github hoặc sqlite)")
+        return False
+    
+    if STORAGE_BACKEND == 'github' and not GITHUB_TOKEN:
+        print("❌ LỖI: GITHUB_TOKEN không được tìm thấy!")
+        return False
+    
+    if LEADER_LEASE_BACKEND:
+        if LEADER_LEASE_BACKEND not in ('file', 'sqlite'):
+            print(f"❌ LỖI: LEADER_LEASE_BACKEND không hợp lệ: {LEADER_LEASE_BACKEND} (chọn file hoặc sqlite)")
+            return False
+        if LEADER_LEASE_BACKEND == 'file' and fcntl is None:
+            print("❌ LỖI: LEADER_LEASE_BACKEND=file cần fcntl (Linux/macOS)")
+            return False
+        if not (VERIFY_PORT and REPLICA_URL and REPLICA_SECRET):
+            print("❌ LỖI: Chạy nhiều replica cần VERIFY_PORT, REPLICA_URL và REPLICA_SECRET!")
+            return False
+    
+    print("✅ Đã load tất cả environment variables")
+    return True
 
-# Kiểm tra biến môi trường
-if not DISCORD_TOKEN:
-    print("❌ LỖI: DISCORD_TOKEN không được tìm thấy!")
-    exit(1)
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+GITHUB_TIMEOUT = aiohttp.ClientTimeout(total=30)
+GITHUB_POOL_SIZE = int(os.getenv('GITHUB_POOL_SIZE', '10'))
+CACHE_TTL = float(os.getenv('CACHE_TTL', '30'))
+COMMIT_BATCH_WINDOW = float(os.getenv('COMMIT_BATCH_WINDOW', '0.5'))
+COMMIT_MAX_RETRIES = int(os.getenv('COMMIT_MAX_RETRIES', '5'))
 
-if not GITHUB_TOKEN:
-    print("❌ LỖI: GITHUB_TOKEN không được tìm thấy!")
-    exit(1)
+# Giới hạn tốc độ gọi GitHub API (token bucket). Khi X-RateLimit-Remaining còn
+# <= GITHUB_RATE_RESERVE thì ngừng đọc (dùng cache cũ) để dành phần còn lại cho lệnh ghi.
+GITHUB_RATE_PER_HOUR = float(os.getenv('GITHUB_RATE_PER_HOUR', '5000'))
+GITHUB_RATE_BURST = float(os.getenv('GITHUB_RATE_BURST', '20'))
+GITHUB_RATE_RESERVE = int(os.getenv('GITHUB_RATE_RESERVE', '200'))
 
-print("✅ Đã load tất cả environment variables")
+# Op log: thay đổi nhỏ chỉ ghi thêm vào file JSON Lines, định kỳ mới gộp vào
+# JSON_FILE_PATH. Loader chỉ đọc JSON_FILE_PATH nên sẽ thấy thay đổi chậm tối
+# đa OPLOG_COMPACT_INTERVAL giây -> mặc định tắt.
+OPLOG_ENABLED = os.getenv('OPLOG_ENABLED', '0') == '1'
+OPLOG_FILE_PATH = os.getenv('OPLOG_FILE_PATH', os.path.splitext(JSON_FILE_PATH)[0] + '.log.jsonl')
+OPLOG_COMPACT_INTERVAL = float(os.getenv('OPLOG_COMPACT_INTERVAL', '300'))
+OPLOG_MAX_BYTES = int(os.getenv('OPLOG_MAX_BYTES', '65536'))
 
-intents = discord.Intents.default()
-intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+# Sharding: GITHUB_SHARDS > 1 chia key ra nhiều file trong SHARD_DIR (không dùng op log).
+# Loader đọc SHARD_DIR/manifest.json rồi tìm key trong file của shard_of(key).
+GITHUB_SHARDS = int(os.getenv('GITHUB_SHARDS', '1'))
+SHARD_DIR = os.getenv('SHARD_DIR', os.path.splitext(JSON_FILE_PATH)[0])
+TAOKEY_MAX_AMOUNT = int(os.getenv('TAOKEY_MAX_AMOUNT', '100000'))
 
-class KeyManager:
-    def __init__(self, github_token, repo_name):
-        self.g = Github(github_token)
-        self.repo = self.g.get_repo(repo_name)
+# Lệnh hàng loạt bằng file TXT/CSV đính kèm
+BULK_MAX_BYTES = int(os.getenv('BULK_MAX_BYTES', str(10 * 1024 * 1024)))
+BULK_MAX_KEYS = int(os.getenv('BULK_MAX_KEYS', '200000'))
+
+# Tự động xóa key hết hạn mỗi EXPIRY_SWEEP_INTERVAL giây (0 = tắt), key bị xóa
+# được lưu lại trong EXPIRED_ARCHIVE_PATH (GitHub) hoặc bảng archived_keys (SQLite)
+EXPIRY_SWEEP_INTERVAL = float(os.getenv('EXPIRY_SWEEP_INTERVAL', '0'))
+EXPIRED_ARCHIVE_PATH = os.getenv('EXPIRED_ARCHIVE_PATH', os.path.splitext(JSON_FILE_PATH)[0] + '.expired.jsonl')
+
+# Debug: đếm lại toàn bộ key mỗi lần lấy thống kê để kiểm tra bộ đếm
+KEYSTORE_DEBUG = os.getenv('KEYSTORE_DEBUG', '0') == '1'
+
+# HTTP /verify?key=&hwid=, /ready, /metrics chạy chung event loop với bot (VERIFY_PORT = 0 -> tắt).
+# Kết quả tra key được cache (LRU), key không tồn tại cũng được cache ngắn hạn.
+VERIFY_HOST = os.getenv('VERIFY_HOST', '0.0.0.0')
+VERIFY_PORT = int(os.getenv('VERIFY_PORT', '0'))
+VERIFY_CACHE_SIZE = int(os.getenv('VERIFY_CACHE_SIZE', '10000'))
+VERIFY_CACHE_TTL = float(os.getenv('VERIFY_CACHE_TTL', '60'))
+VERIFY_NEGATIVE_TTL = float(os.getenv('VERIFY_NEGATIVE_TTL', '10'))
+
+# JSON_COMPACT=1: ghi file key không thụt lề (nhỏ hơn, loader đọc được như cũ)
+JSON_COMPACT = os.getenv('JSON_COMPACT', '0') == '1'
+
+# Số mẫu gần nhất giữ lại cho mỗi histogram (tính p50/p95/p99)
+METRICS_SAMPLES = int(os.getenv('METRICS_SAMPLES', '1024'))
+
+# Journal ghi trước: lệnh ghi được fsync vào JOURNAL_PATH, áp dụng vào bộ nhớ rồi trả lời ngay,
+# luồng nền đẩy lên backend sau (JOURNAL_PATH rỗng = tắt). Trên Railway cần đặt file trong volume.
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', '')
+JOURNAL_RETRY_MAX = float(os.getenv('JOURNAL_RETRY_MAX', '60'))
+
+# Lịch sử thay đổi key (ai, lệnh nào, trước/sau) trong SQLite cục bộ, AUDIT_DB_PATH rỗng = tắt.
+# Chỉ giữ AUDIT_RETENTION_DAYS ngày và tối đa AUDIT_MAX_EVENTS sự kiện, dọn mỗi AUDIT_ROTATE_INTERVAL giây.
+AUDIT_DB_PATH = os.getenv('AUDIT_DB_PATH', 'audit.db')
+AUDIT_RETENTION_DAYS = float(os.getenv('AUDIT_RETENTION_DAYS', '90'))
+AUDIT_MAX_EVENTS = int(os.getenv('AUDIT_MAX_EVENTS', '1000000'))
+AUDIT_ROTATE_INTERVAL = float(os.getenv('AUDIT_ROTATE_INTERVAL', '3600'))
+
+# Chạy nhiều replica: bầu một leader bằng lease, chỉ leader ghi dữ liệu, follower chuyển lệnh ghi
+# tới leader qua REPLICA_URL/internal/write (cần VERIFY_PORT). LEADER_LEASE_BACKEND rỗng = một replica.
+LEADER_LEASE_BACKEND = os.getenv('LEADER_LEASE_BACKEND', '').lower()
+LEADER_LEASE_PATH = os.getenv('LEADER_LEASE_PATH', '')
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', '15'))
+REPLICA_ID = os.getenv('REPLICA_ID') or os.getenv('RAILWAY_REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+REPLICA_URL = os.getenv('REPLICA_URL', '').rstrip('/')
+REPLICA_SECRET = os.getenv('REPLICA_SECRET', '')
+# Slash command: đồng bộ lên Discord khi khởi động (SLASH_GUILD_ID = đồng bộ ngay cho một server để thử)
+SLASH_SYNC = os.getenv('SLASH_SYNC', '1') == '1'
+SLASH_GUILD_ID = os.getenv('SLASH_GUILD_ID', '')
+
+# Chia shard gateway Discord giữa các replica; không chia thì chỉ leader trả lời lệnh
+DISCORD_SHARD_ID = int(os.getenv('DISCORD_SHARD_ID', '0'))
+DISCORD_SHARD_COUNT = int(os.getenv('DISCORD_SHARD_COUNT', '1'))
+
+class GitHubAPIError(Exception):
+    """Lỗi trả về từ GitHub API"""
+    def __init__(self, status, message=""):
+        super().__init__(f"GitHub API {status}: {message}")
+        self.status = status
+
+class KeyOpError(Exception):
+    """Thao tác không hợp lệ với dữ liệu hiện tại (thông báo gửi thẳng cho user)"""
+
+class CommitError(Exception):
+    """Không ghi được thay đổi lên GitHub"""
+
+class PartialCommitError(CommitError):
+    """Chỉ ghi được một phần thay đổi (backend chia shard), không được ghi lại cả lô.
     
-    def generate_key(self, length=16):
-        """Tạo key ngẫu nhiên"""
-        chars = string.ascii_uppercase + string.digits
-        return ''.join(random.choice(chars) for _ in range(length))
+    written/failed: các key đã ghi/chưa ghi; shards: shard -> None nếu đã ghi, lỗi nếu chưa.
+    result: kết quả của op nhận lỗi này (vd. tên các key taokey đã tạo).
+    """
+    def __init__(self, message, written, failed, shards, result=None):
+        super().__init__(message)
+        self.written = written
+        self.failed = failed
+        self.shards = shards
+        self.result = result
+        # Kết quả (result, error) của từng op trong lô, do backend gắn vào
+        self.results = None
+
+def is_transient(error):
+    """Lỗi có thể hết khi thử lại: xung đột sha, rate limit, lỗi 5xx hoặc mạng"""
+    if isinstance(error, GitHubAPIError):
+        return error.status in (409, 422, 429) or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+def parse_expiry(expires):
+    """Chuyển chuỗi ISO của trường expires thành datetime (UTC)"""
+    return datetime.datetime.fromisoformat(expires.replace('Z', ''))
+
+def shard_of(key, shards):
+    """Shard chứa key: 8 ký tự hex đầu của sha256(key) chia lấy dư cho số shard"""
+    return int(hashlib.sha256(key.encode()).hexdigest()[:8], 16) % shards
+
+def expiry_ts(expiry_date):
+    """Đổi datetime (UTC) sang epoch seconds"""
+    return expiry_date.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+class Metrics:
+    """Số liệu hiệu năng trong bộ nhớ: histogram thời gian, counter và gauge theo nhãn"""
+    QUANTILES = (0.5, 0.95, 0.99)
     
-    async def get_current_json(self):
-        """Lấy nội dung JSON hiện tại từ GitHub"""
+    def __init__(self, samples=METRICS_SAMPLES):
+        self.samples = samples
+        # (tên, nhãn) -> [mẫu gần nhất, tổng số lần, tổng thời gian]
+        self.histograms = {}
+        self.counters = defaultdict(float)
+        self.gauges = {}
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [deque(maxlen=self.samples), 0, 0.0]
+        hist[0].append(value)
+        hist[1] += 1
+        hist[2] += value
+    
+    def inc(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+    
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        """Đo thời gian khối with (kể cả khi lỗi) vào histogram name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def summary(self, name):
+        """Danh sách (nhãn, số lần, {quantile: giây}) của histogram name"""
+        results = []
+        for (hist_name, labels), (samples, count, _) in self.histograms.items():
+            if hist_name != name or not samples:
+                continue
+            ordered = sorted(samples)
+            quantiles = {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in self.QUANTILES}
+            results.append((dict(labels), count, quantiles))
+        return results
+    
+    def total(self, name, **labels):
+        """Tổng counter name trên các nhãn khớp labels"""
+        return sum(
+            value for (counter_name, counter_labels), value in self.counters.items()
+            if counter_name == name and labels.items() <= dict(counter_labels).items()
+        )
+    
+    def render_prometheus(self):
+        """Xuất toàn bộ số liệu theo định dạng text của Prometheus"""
+        def fmt(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return '{' + ','.join(pairs) + '}' if pairs else ''
+        
+        lines, typed = [], set()
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE keybot_{name} summary")
+            for labels, count, quantiles in self.summary(name):
+                labels = tuple(sorted(labels.items()))
+                for q, value in quantiles.items():
+                    lines.append(f"keybot_{name}{fmt(labels, (('quantile', q),))} {value:.6f}")
+                lines.append(f"keybot_{name}_sum{fmt(labels)} {self.histograms[(name, labels)][2]:.6f}")
+                lines.append(f"keybot_{name}_count{fmt(labels)} {count}")
+        for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+            for (name, labels), value in sorted(values.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE keybot_{name} {kind}")
+                lines.append(f"keybot_{name}{fmt(labels)} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class Key:
+    """Bản ghi một key (__slots__), đọc/ghi được như dict để op và lệnh cũ vẫn dùng được.
+    
+    unlimited = None nghĩa là file không có trường này; trường lạ giữ trong extra.
+    """
+    __slots__ = ('key', 'hwid', 'type', 'expires', 'unlimited', 'extra')
+    FIELDS = ('key', 'hwid', 'type', 'expires', 'unlimited')
+    FIELD_SET = frozenset(FIELDS)
+    
+    def __init__(self, key, hwid='', type=None, expires=None, unlimited=None, extra=None):
+        self.key = key
+        self.hwid = hwid
+        self.type = type
+        self.expires = expires
+        self.unlimited = unlimited
+        self.extra = extra
+    
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, Key):
+            return data
+        extra = None
+        if not data.keys() <= cls.FIELD_SET:
+            extra = {k: v for k, v in data.items() if k not in cls.FIELD_SET}
+        return cls(data['key'], data.get('hwid', ''), data.get('type'), data.get('expires'), data.get('unlimited'), extra)
+    
+    def to_dict(self):
+        data = {"key": self.key, "hwid": self.hwid, "type": self.type, "expires": self.expires}
+        if self.unlimited is not None:
+            data["unlimited"] = self.unlimited
+        if self.extra:
+            data.update(self.extra)
+        return data
+    
+    def copy(self):
+        return Key(self.key, self.hwid, self.type, self.expires, self.unlimited, dict(self.extra) if self.extra else None)
+    
+    def keys(self):
+        return self.to_dict().keys()
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __getitem__(self, name):
+        if name in Key.FIELD_SET:
+            value = getattr(self, name)
+            if name != 'unlimited' or value is not None:
+                return value
+        elif self.extra and name in self.extra:
+            return self.extra[name]
+        raise KeyError(name)
+    
+    def __setitem__(self, name, value):
+        if name in Key.FIELD_SET:
+            setattr(self, name, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[name] = value
+    
+    def __contains__(self, name):
         try:
-            contents = self.repo.get_contents(JSON_FILE_PATH)
-            current_data = json.loads(contents.decoded_content.decode())
-            return current_data
+            self[name]
+            return True
+        except KeyError:
+            return False
+    
+    def __eq__(self, other):
+        if isinstance(other, (Key, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+    
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+    
+    def items(self):
+        return self.to_dict().items()
+    
+    def update(self, fields=(), **kwargs):
+        for name, value in dict(fields, **kwargs).items():
+            self[name] = value
+    
+    def __repr__(self):
+        return f"Key({self.to_dict()!r})"
+
+def _json_default(obj):
+    if isinstance(obj, Key):
+        return obj.to_dict()
+    raise TypeError(f"Không chuyển được {type(obj).__name__} sang JSON")
+
+def dumps_json(obj, pretty=False):
+    """Ghi JSON ra bytes (orjson nếu có). Không escape ký tự Unicode như ensure_ascii=False"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, indent=2, ensure_ascii=False, default=_json_default).encode()
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode()
+
+def loads_json(data):
+    """Đọc JSON từ bytes/str (orjson nếu có)"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+class KeyStore:
+    """Danh sách key có index theo key, loại, HWID và ngày hết hạn.
+    
+    Thứ tự key được giữ nguyên như trong file JSON. Mọi thay đổi phải đi qua
+    các hàm của KeyStore để index luôn đúng. Ngày hết hạn chỉ parse một lần,
+    lưu trong mảng (epoch, key) đã sắp xếp để đếm/lọc key hết hạn bằng bisect.
+    Số key đã kích hoạt và key unlimited được đếm dần theo từng thay đổi.
+    Tên key được giữ trong mảng đã sắp xếp để tìm theo tiền tố bằng bisect.
+    Key được lưu dưới dạng Key (dict truyền vào add() sẽ được chuyển sang Key).
+    """
+    # Từ số key này trở lên, remove_many/update_many lọc hoặc sắp xếp lại các mảng đã
+    # sắp xếp một lần thay vì xóa/chèn từng phần tử
+    BULK_MIN = 128
+    
+    def __init__(self, keys=()):
+        self._keys = {}
+        self._by_type = defaultdict(set)
+        self._by_hwid = defaultdict(set)
+        self._expiry = {}
+        self._expiry_order = []
+        self._sorted_keys = []
+        # Vị trí key trong file, để trả kết quả lọc theo đúng thứ tự file
+        self._pos = {}
+        self._next_pos = 0
+        # Key được rollback() đưa lại sau khi đã xóa: đang nằm cuối _keys thay vì đúng vị trí
+        self._misplaced = set()
+        self._activated = 0
+        self._unlimited = 0
+        self.changes = None
+        # key -> (Key đang có hoặc None, bản sao trước khi sửa, vị trí) để rollback(); None = không ghi
+        self._undo = None
+        # Nạp hàng loạt: thêm vào cuối rồi sắp xếp một lần thay vì insort từng key
+        self._bulk = True
+        for key_obj in keys:
+            self.add(key_obj)
+        self._expiry_order.sort()
+        self._sorted_keys.sort()
+        self._bulk = False
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def __iter__(self):
+        self._restore_order()
+        return iter(self._keys.values())
+    
+    def __contains__(self, key):
+        return key in self._keys
+    
+    def _index(self, key_obj):
+        key = key_obj['key']
+        self._by_type[key_obj.get('type')].add(key)
+        self._by_hwid[key_obj.get('hwid', '')].add(key)
+        self._activated += bool(key_obj.get('hwid'))
+        self._unlimited += bool(key_obj.get('unlimited'))
+        if key_obj.get('expires'):
+            expiry = parse_expiry(key_obj['expires'])
+            self._expiry[key] = expiry
+            if self._bulk:
+                self._expiry_order.append((expiry_ts(expiry), key))
+            else:
+                insort(self._expiry_order, (expiry_ts(expiry), key))
+    
+    def _unindex(self, key_obj, ordered=True):
+        """Gỡ key khỏi các index. ordered=False: không xóa khỏi _expiry_order (người gọi tự lọc lại)"""
+        key = key_obj['key']
+        self._by_type[key_obj.get('type')].discard(key)
+        self._by_hwid[key_obj.get('hwid', '')].discard(key)
+        self._activated -= bool(key_obj.get('hwid'))
+        self._unlimited -= bool(key_obj.get('unlimited'))
+        expiry = self._expiry.pop(key, None)
+        if expiry is not None and ordered:
+            entry = (expiry_ts(expiry), key)
+            i = bisect_left(self._expiry_order, entry)
+            if i < len(self._expiry_order) and self._expiry_order[i] == entry:
+                del self._expiry_order[i]
+    
+    def _remember(self, key):
+        """Lưu trạng thái của key trước lần sửa đầu tiên, cho rollback()"""
+        if self._undo is not None and key not in self._undo:
+            key_obj = self._keys.get(key)
+            self._undo[key] = (key_obj, key_obj.copy() if key_obj is not None else None, self._pos.get(key))
+    
+    def _restore_order(self):
+        """Xếp lại _keys theo vị trí trong file nếu rollback() đã đưa lại key bị xóa"""
+        if self._misplaced:
+            self._keys = {key: self._keys[key] for key in sorted(self._keys, key=self._pos.__getitem__)}
+            self._misplaced.clear()
+    
+    def get(self, key):
+        """Tìm key, trả về None nếu không có"""
+        return self._keys.get(key)
+    
+    def add(self, key_obj):
+        """Thêm key mới (ghi đè nếu trùng key)"""
+        key_obj = Key.from_dict(key_obj)
+        self._remember(key_obj['key'])
+        old = self._keys.get(key_obj['key'])
+        if old is not None:
+            self._unindex(old)
+        else:
+            self._pos[key_obj['key']] = self._next_pos
+            self._next_pos += 1
+            if self._bulk:
+                self._sorted_keys.append(key_obj['key'])
+            else:
+                insort(self._sorted_keys, key_obj['key'])
+        self._keys[key_obj['key']] = key_obj
+        self._index(key_obj)
+        if self.changes is not None:
+            self.changes[key_obj['key']] = key_obj
+    
+    def add_many(self, key_objs):
+        """Thêm nhiều key (ghi đè nếu trùng key).
+        
+        Lô lớn: gỡ index của các key bị ghi đè một lần, thêm vào cuối rồi sắp xếp lại
+        các mảng một lần thay vì insort từng key.
+        """
+        key_objs = list({key_obj['key']: Key.from_dict(key_obj) for key_obj in key_objs}.values())
+        if len(key_objs) < self.BULK_MIN:
+            for key_obj in key_objs:
+                self.add(key_obj)
+            return
+        
+        expiry_entries = []
+        for key_obj in key_objs:
+            key = key_obj['key']
+            self._remember(key)
+            old = self._keys.get(key)
+            if old is not None:
+                expiry = self._expiry.get(key)
+                if expiry is not None:
+                    expiry_entries.append((expiry_ts(expiry), key))
+                self._unindex(old, ordered=False)
+        self._remove_expiry_entries(expiry_entries)
+        
+        self._bulk = True
+        try:
+            for key_obj in key_objs:
+                key = key_obj['key']
+                if key not in self._keys:
+                    self._pos[key] = self._next_pos
+                    self._next_pos += 1
+                    self._sorted_keys.append(key)
+                self._keys[key] = key_obj
+                self._index(key_obj)
+                if self.changes is not None:
+                    self.changes[key] = key_obj
+        finally:
+            self._bulk = False
+            self._expiry_order.sort()
+            self._sorted_keys.sort()
+    
+    def update(self, key, **fields):
+        """Sửa các trường của key và cập nhật index"""
+        key_obj = self._keys[key]
+        self._remember(key)
+        self._unindex(key_obj)
+        key_obj.update(fields)
+        self._index(key_obj)
+        if self.changes is not None:
+            self.changes[key] = key_obj
+        return key_obj
+    
+    def update_many(self, updates):
+        """Sửa nhiều key (key -> các trường cần đổi), trả về danh sách Key đã sửa.
+        
+        Lô lớn: gỡ index của tất cả key, sửa, rồi sắp xếp lại _expiry_order một lần.
+        """
+        if len(updates) < self.BULK_MIN:
+            return [self.update(key, **fields) for key, fields in updates.items()]
+        
+        expiry_entries = []
+        for key in updates:
+            self._remember(key)
+            expiry = self._expiry.get(key)
+            if expiry is not None:
+                expiry_entries.append((expiry_ts(expiry), key))
+            self._unindex(self._keys[key], ordered=False)
+        self._remove_expiry_entries(expiry_entries)
+        
+        updated = []
+        self._bulk = True
+        try:
+            for key, fields in updates.items():
+                key_obj = self._keys[key]
+                key_obj.update(fields)
+                self._index(key_obj)
+                if self.changes is not None:
+                    self.changes[key] = key_obj
+                updated.append(key_obj)
+        finally:
+            self._bulk = False
+            self._expiry_order.sort()
+        return updated
+    
+    def remove(self, key):
+        """Xóa key, trả về key đã xóa hoặc None"""
+        self._remember(key)
+        key_obj = self._keys.pop(key, None)
+        if key_obj is not None:
+            self._unindex(key_obj)
+            del self._pos[key]
+            self._misplaced.discard(key)
+            del self._sorted_keys[bisect_left(self._sorted_keys, key)]
+            if self.changes is not None:
+                self.changes[key] = None
+        return key_obj
+    
+    def remove_many(self, keys):
+        """Xóa nhiều key, trả về (danh sách đã xóa, danh sách không tìm thấy)"""
+        keys = list(dict.fromkeys(keys))
+        # Xóa từng phần tử trong mảng đã sắp xếp là O(n) mỗi key: với lô lớn thì gỡ
+        # index trước rồi lọc _sorted_keys một lần theo tập key đã xóa
+        bulk = len(keys) >= self.BULK_MIN
+        deleted, not_found, expiry_entries = [], [], []
+        for key in keys:
+            self._remember(key)
+            key_obj = self._keys.pop(key, None)
+            if key_obj is None:
+                not_found.append(key)
+                continue
+            expiry = self._expiry.get(key)
+            if expiry is not None:
+                expiry_entries.append((expiry_ts(expiry), key))
+            self._unindex(key_obj, ordered=False)
+            del self._pos[key]
+            if not bulk:
+                del self._sorted_keys[bisect_left(self._sorted_keys, key)]
+            deleted.append(key)
+            if self.changes is not None:
+                self.changes[key] = None
+        self._misplaced.difference_update(deleted)
+        if bulk and deleted:
+            removed = set(deleted)
+            self._sorted_keys = [key for key in self._sorted_keys if key not in removed]
+        self._remove_expiry_entries(expiry_entries)
+        return deleted, not_found
+    
+    def _remove_expiry_entries(self, entries):
+        """Xóa các (epoch, key) khỏi _expiry_order.
+        
+        Key hết hạn luôn nằm ở đầu mảng, nên khi xóa key hết hạn (hoặc lô lớn) chỉ cần
+        lọc lại một lần đoạn đầu tới entry cuối cùng; các key rải rác thì xóa từng entry.
+        """
+        if not entries:
+            return
+        end = bisect_right(self._expiry_order, max(entries))
+        if end <= 2 * len(entries) or len(entries) >= self.BULK_MIN:
+            removed = {key for _, key in entries}
+            self._expiry_order[:end] = [entry for entry in self._expiry_order[:end] if entry[1] not in removed]
+            return
+        for entry in entries:
+            i = bisect_left(self._expiry_order, entry)
+            if i < len(self._expiry_order) and self._expiry_order[i] == entry:
+                del self._expiry_order[i]
+    
+    def of_type(self, key_type):
+        """Các key thuộc một loại"""
+        return [self._keys[k] for k in self._by_type.get(key_type, ())]
+    
+    def count_type(self, key_type):
+        return len(self._by_type.get(key_type, ()))
+    
+    def with_hwid(self, hwid):
+        """Các key đang gắn với một HWID"""
+        return [self._keys[k] for k in self._by_hwid.get(hwid, ())]
+    
+    def expiry_of(self, key):
+        """Ngày hết hạn đã parse của key (None nếu không có hạn)"""
+        return self._expiry.get(key)
+    
+    def _expiry_range(self, expires_after=None, expires_before=None):
+        """Vị trí [đầu, cuối) trong _expiry_order của các key hết hạn trong khoảng"""
+        start = 0 if expires_after is None else bisect_left(self._expiry_order, (expiry_ts(expires_after),))
+        end = len(self._expiry_order) if expires_before is None else bisect_left(self._expiry_order, (expiry_ts(expires_before),))
+        return start, max(start, end)
+    
+    def expired(self, now=None):
+        """Các key đã hết hạn, theo thứ tự ngày hết hạn"""
+        _, end = self._expiry_range(expires_before=now or datetime.datetime.utcnow())
+        return [self._keys[key] for _, key in self._expiry_order[:end]]
+    
+    def count_expired(self, now=None):
+        """Số key đã hết hạn (O(log n))"""
+        return self._expiry_range(expires_before=now or datetime.datetime.utcnow())[1]
+    
+    def stats(self, now=None):
+        """Thống kê số key theo loại, kích hoạt, unlimited và hết hạn (không duyệt key)"""
+        stats = {
+            'total': len(self._keys),
+            'single': self.count_type('single'),
+            'multi': self.count_type('multi'),
+            'unlimited': self._unlimited,
+            'activated': self._activated,
+            'unactivated': len(self._keys) - self._activated,
+            'expired': self.count_expired(now),
+        }
+        if KEYSTORE_DEBUG:
+            recount = self._recount(now)
+            if recount != stats:
+                print(f"⚠️ Bộ đếm KeyStore bị lệch: {stats} != {recount}")
+        return stats
+    
+    def _recount(self, now=None):
+        """Đếm lại toàn bộ key, chỉ dùng để kiểm tra stats() khi debug"""
+        now = now or datetime.datetime.utcnow()
+        keys = list(self._keys.values())
+        activated = sum(1 for k in keys if k.get('hwid'))
+        return {
+            'total': len(keys),
+            'single': sum(1 for k in keys if k.get('type') == 'single'),
+            'multi': sum(1 for k in keys if k.get('type') == 'multi'),
+            'unlimited': sum(1 for k in keys if k.get('unlimited')),
+            'activated': activated,
+            'unactivated': len(keys) - activated,
+            'expired': sum(1 for k in keys if k.get('expires') and parse_expiry(k['expires']) < now),
+        }
+    
+    def _prefix_range(self, prefix):
+        """Vị trí [đầu, cuối) trong _sorted_keys của các key bắt đầu bằng prefix"""
+        start = bisect_left(self._sorted_keys, prefix)
+        end = bisect_left(self._sorted_keys, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return start, end
+    
+    def query(self, key_type=None, hwid=None, expires_before=None, expires_after=None, limit=None,
+              prefix=None, activated=None):
+        """Lọc key theo loại, HWID, tiền tố, đã kích hoạt hay chưa và khoảng hết hạn [expires_after, expires_before).
+        
+        Chỉ duyệt index nhỏ nhất trong các điều kiện (đoạn tiền tố, đoạn hết hạn, tập
+        HWID/loại) nên thời gian tỉ lệ với kết quả chứ không với cả store. Kết quả xếp
+        theo ngày hết hạn nếu lọc theo hạn, theo tên key nếu lọc theo tiền tố, còn lại
+        theo thứ tự trong file.
+        """
+        has_expiry = expires_before is not None or expires_after is not None
+        # (số key của index, thứ tự của index, hàm lấy danh sách key)
+        sources = []
+        if has_expiry:
+            start, end = self._expiry_range(expires_after, expires_before)
+            sources.append((end - start, 'expiry', lambda: [key for _, key in self._expiry_order[start:end]]))
+        if prefix:
+            prefix_start, prefix_end = self._prefix_range(prefix)
+            sources.append((prefix_end - prefix_start, 'key', lambda: self._sorted_keys[prefix_start:prefix_end]))
+        if hwid is not None or activated is False:
+            by_hwid = self._by_hwid.get(hwid or '', ())
+            sources.append((len(by_hwid), None, lambda: by_hwid))
+        if key_type is not None:
+            by_type = self._by_type.get(key_type, ())
+            sources.append((len(by_type), None, lambda: by_type))
+        self._restore_order()
+        sources.append((len(self._keys), 'file', lambda: self._keys))
+        _, source_order, source = min(sources, key=lambda item: item[0])
+        
+        order = 'expiry' if has_expiry else 'key' if prefix else 'file'
+        results = []
+        for key in source():
+            key_obj = self._keys[key]
+            if key_type is not None and key_obj['type'] != key_type:
+                continue
+            if hwid is not None and key_obj['hwid'] != hwid:
+                continue
+            if activated is not None and bool(key_obj['hwid']) != activated:
+                continue
+            if prefix and not key.startswith(prefix):
+                continue
+            if has_expiry:
+                expiry = self._expiry.get(key)
+                if (expiry is None or (expires_after is not None and expiry < expires_after)
+                        or (expires_before is not None and expiry >= expires_before)):
+                    continue
+            results.append(key_obj)
+            if source_order == order and limit is not None and len(results) >= limit:
+                break
+        
+        if source_order != order:
+            if order == 'expiry':
+                results.sort(key=lambda k: (expiry_ts(self._expiry[k['key']]), k['key']))
+            elif order == 'key':
+                results.sort(key=lambda k: k['key'])
+            else:
+                results.sort(key=lambda k: self._pos[k['key']])
+        return results if limit is None else results[:limit]
+    
+    def slice(self, start, end):
+        """Lấy một đoạn key theo thứ tự trong file (dùng cho phân trang)"""
+        self._restore_order()
+        return list(islice(self._keys.values(), start, end))
+    
+    def track_changes(self, undo=False):
+        """Bắt đầu ghi lại trạng thái cuối của các key bị sửa/xóa (cho op log).
+        
+        undo=True: lưu cả trạng thái trước để rollback() được.
+        """
+        self.changes = {}
+        self._undo = {} if undo else None
+    
+    def rollback(self):
+        """Đưa các key đã sửa từ lần track_changes(undo=True) về trạng thái trước.
+        
+        Trạng thái cũ được ghi lại vào chính Key ban đầu (danh sách đang giữ Key đó không
+        thấy thay đổi đã hủy); key đã xóa lấy lại vị trí cũ trong file.
+        """
+        undo, self.changes, self._undo = self._undo, None, None
+        self.remove_many(key for key, (original, _, _) in undo.items() if original is None)
+        restore = [(key, original, before, pos) for key, (original, before, pos) in undo.items() if original is not None]
+        bulk = len(restore) >= self.BULK_MIN
+        
+        expiry_entries = []
+        for key, *_ in restore:
+            current = self._keys.get(key)
+            if current is not None:
+                expiry = self._expiry.get(key)
+                if bulk and expiry is not None:
+                    expiry_entries.append((expiry_ts(expiry), key))
+                self._unindex(current, ordered=not bulk)
+        self._remove_expiry_entries(expiry_entries)
+        
+        self._bulk = bulk
+        try:
+            for key, original, before, pos in restore:
+                for name in Key.__slots__:
+                    setattr(original, name, getattr(before, name))
+                if key not in self._keys:
+                    if bulk:
+                        self._sorted_keys.append(key)
+                    else:
+                        insort(self._sorted_keys, key)
+                if self._pos.get(key) != pos:
+                    # Key đã bị xóa (rồi có thể thêm lại ở cuối): trả về vị trí cũ
+                    self._pos[key] = pos
+                    self._misplaced.add(key)
+                self._keys[key] = original
+                self._index(original)
+        finally:
+            if bulk:
+                self._bulk = False
+                self._expiry_order.sort()
+                self._sorted_keys.sort()
+    
+    def apply_log(self, data):
+        """Áp dụng các dòng op log (JSON Lines) lên store"""
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            record = loads_json(line)
+            if record['op'] == 'upsert':
+                self.add(record['data'])
+            elif record['op'] == 'delete':
+                self.remove(record['key'])
+    
+    def copy(self):
+        """Bản sao độc lập để chỉnh sửa mà không ảnh hưởng cache"""
+        self._restore_order()
+        clone = KeyStore()
+        clone._keys = {k: v.copy() for k, v in self._keys.items()}
+        clone._by_type = defaultdict(set, {t: set(ks) for t, ks in self._by_type.items()})
+        clone._by_hwid = defaultdict(set, {h: set(ks) for h, ks in self._by_hwid.items()})
+        clone._expiry = dict(self._expiry)
+        clone._expiry_order = list(self._expiry_order)
+        clone._sorted_keys = list(self._sorted_keys)
+        clone._pos = dict(self._pos)
+        clone._next_pos = self._next_pos
+        clone._activated = self._activated
+        clone._unlimited = self._unlimited
+        return clone
+    
+    def to_list(self):
+        """Danh sách key (dict) để ghi ra JSON, giữ nguyên thứ tự"""
+        self._restore_order()
+        return [key_obj.to_dict() for key_obj in self._keys.values()]
+
+class KeySnapshot:
+    """KeyStore trong bộ nhớ, gắn với sha/ETag của file trên GitHub"""
+    def __init__(self, store, sha, etag):
+        self.store = store
+        self.sha = sha
+        self.etag = etag
+        # Trạng thái op log đã áp dụng vào store
+        self.log_bytes = b''
+        self.log_sha = None
+        self.log_etag = None
+        self.fetched_at = time.monotonic()
+    
+    def is_fresh(self):
+        return time.monotonic() - self.fetched_at < CACHE_TTL
+
+class CommitQueue:
+    """Hàng đợi ghi duy nhất.
+    
+    Các thao tác đến trong cùng một khoảng COMMIT_BATCH_WINDOW được gom lại
+    và giao cho backend áp dụng trong một lần ghi (một commit GitHub hoặc một
+    transaction SQLite).
+    """
+    def __init__(self, backend, window=COMMIT_BATCH_WINDOW):
+        self.backend = backend
+        self.window = window
+        self._queue = asyncio.Queue()
+        self._task = None
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while not self._queue.empty():
+            self._fail([self._queue.get_nowait()], "Bot đang tắt")
+    
+    async def submit(self, op, keys=None):
+        """Đưa thao tác op(store) vào hàng đợi, chờ tới khi được commit"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, keys, future))
+        return await future
+    
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.window)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            try:
+                await self._commit_batch(batch)
+            except asyncio.CancelledError:
+                self._fail(batch, "Bot đang tắt")
+                raise
+            except Exception as e:
+                print(f"❌ Lỗi khi ghi dữ liệu: {e}")
+                self._fail(batch, str(e))
+    
+    def _fail(self, batch, reason):
+        for *_, future in batch:
+            if not future.done():
+                future.set_exception(CommitError(reason))
+    
+    async def _commit_batch(self, batch):
+        batch = [item for item in batch if not item[-1].done()]
+        if not batch:
+            return
+        
+        keys = set()
+        for _, op_keys, _ in batch:
+            if op_keys is None:
+                keys = None
+                break
+            keys.update(op_keys)
+        
+        metrics.observe('commit_batch_size', len(batch))
+        try:
+            with metrics.timer('storage_seconds', op='apply'):
+                results = await self.backend.apply([op for op, _, _ in batch], keys)
+        except PartialCommitError as e:
+            # Không báo lỗi chung (người dùng thử lại sẽ ghi trùng phần đã xong):
+            # mỗi lệnh nhận phần đã/chưa ghi cùng kết quả op của nó
+            print(f"❌ Lỗi khi ghi dữ liệu: {e}")
+            for (_, _, future), (result, error) in zip(batch, e.results or [(None, None)] * len(batch)):
+                if not future.done():
+                    future.set_exception(error or PartialCommitError(str(e), e.written, e.failed, e.shards, result))
+            return
+        for (_, _, future), (result, error) in zip(batch, results):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+class KeyBackend:
+    """Giao diện lưu trữ key.
+    
+    - load(): toàn bộ key dưới dạng KeyStore (chỉ đọc, có thể lấy từ cache)
+    - get(key): một key hoặc None
+    - upsert_many(key_objs) / delete_many(keys): ghi hàng loạt
+    - query(...): lọc theo loại, HWID, tiền tố key, kích hoạt, khoảng ngày hết hạn
+    - archive(key_objs): lưu lại các key sắp bị xóa (key hết hạn)
+    - load_admins() / update_admins(change, seed): danh sách admin đã lưu
+      (None nếu chưa lưu lần nào); change(set) sửa tập admin tại chỗ
+    - apply(ops, keys): áp dụng lần lượt các thao tác op(store) trong một lần
+      ghi, trả về [(kết quả, KeyOpError hoặc None)] theo đúng thứ tự. keys là
+      tập key mà ops đụng tới (None = không biết trước)
+    - invalidate(): bỏ cache đọc, khi replica khác vừa ghi dữ liệu
+    - cached(): KeyStore đang có trong bộ nhớ hoặc None, không bao giờ đọc đĩa/mạng
+    """
+    async def start(self):
+        pass
+    
+    async def close(self):
+        pass
+    
+    def invalidate(self):
+        pass
+    
+    def cached(self):
+        return None
+    
+    async def load(self):
+        raise NotImplementedError
+    
+    async def get(self, key):
+        raise NotImplementedError
+    
+    async def upsert_many(self, key_objs):
+        def upsert(store):
+            for key_obj in key_objs:
+                store.add(key_obj.copy())
+        await self.apply([upsert], {key_obj['key'] for key_obj in key_objs})
+    
+    async def delete_many(self, keys):
+        """Xóa nhiều key, trả về (danh sách đã xóa, danh sách không tìm thấy)"""
+        [(result, _)] = await self.apply([lambda store: store.remove_many(keys)], set(keys))
+        return result
+    
+    async def query(self, key_type=None, hwid=None, expires_before=None, expires_after=None, limit=None,
+                    prefix=None, activated=None):
+        raise NotImplementedError
+    
+    async def archive(self, key_objs):
+        raise NotImplementedError
+    
+    async def load_admins(self):
+        raise NotImplementedError
+    
+    async def update_admins(self, change, seed):
+        raise NotImplementedError
+    
+    async def apply(self, ops, keys=None):
+        raise NotImplementedError
+
+def run_ops(store, ops):
+    """Chạy các thao tác op(store), gom kết quả hoặc KeyOpError của từng thao tác"""
+    results = []
+    for op in ops:
+        try:
+            results.append((op(store), None))
+        except KeyOpError as e:
+            results.append((None, e))
+    return results
+
+# Thao tác ghi có tên, để follower chuyển tiếp được tới leader: op(store, **args) với KeyManager.submit,
+# op(admins, **args) với KeyManager.update_admins. Tham số và kết quả phải chuyển được sang JSON.
+WRITE_OPS = {}
+
+def write_op(func):
+    """Đăng ký thao tác ghi theo tên hàm"""
+    WRITE_OPS[func.__name__] = func
+    return func
+
+# (ID người thực hiện, tên lệnh) của lệnh đang chạy, để ghi lịch sử thay đổi
+audit_context = contextvars.ContextVar('audit_context', default=(None, None))
+
+def audited(op, keys, events):
+    """Bọc op(store): ghi trạng thái trước/sau của các key trong keys vào events"""
+    keys = list(dict.fromkeys(keys))
+    
+    def snapshot(store):
+        states = {}
+        for key in keys:
+            key_obj = store.get(key)
+            states[key] = dict(key_obj) if key_obj is not None else None
+        return states
+    
+    def run(store):
+        before = snapshot(store)
+        result = op(store)
+        after = snapshot(store)
+        # Backend có thể chạy lại op khi xung đột, chỉ giữ lần cuối
+        events[:] = [(key, before[key], after[key]) for key in keys if before[key] != after[key]]
+        return result
+    return run
+
+def resolve_op(op, args):
+    """Tên thao tác -> hàm op(target) đã gắn args; hàm truyền trực tiếp giữ nguyên"""
+    if isinstance(op, str):
+        return functools.partial(WRITE_OPS[op], **args)
+    return op
+
+@write_op
+def apply_changes(store, changes):
+    """Ghi trạng thái cuối của các key (key -> dữ liệu, None = đã xóa), dùng khi đẩy journal"""
+    store.remove_many(key for key, key_obj in changes.items() if key_obj is None)
+    store.add_many(key_obj.copy() for key_obj in changes.values() if key_obj is not None)
+
+@write_op
+def remove_expired_keys(store, names):
+    """Xóa các key trong names còn hết hạn lúc commit, trả về số key đã xóa"""
+    # Key được gia hạn trong lúc chờ commit thì giữ lại
+    now = datetime.datetime.utcnow()
+    deleted, _ = store.remove_many(key for key in names if (store.expiry_of(key) or now) < now)
+    return len(deleted)
+
+class GitHubRateLimiter:
+    """Token bucket trước mọi request GitHub, đồng bộ theo header X-RateLimit-*"""
+    def __init__(self, per_hour=GITHUB_RATE_PER_HOUR, burst=GITHUB_RATE_BURST, reserve=GITHUB_RATE_RESERVE):
+        self.rate = per_hour / 3600
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # Theo header của response gần nhất (None = chưa biết)
+        self.remaining = None
+        self.reset_at = 0
+    
+    async def acquire(self, write=False):
+        """Chờ tới lượt gửi request. Raise GitHubAPIError(429) nếu sắp hết giới hạn giờ"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            
+            floor = 0 if write else self.reserve
+            if self.remaining is not None and self.remaining <= floor:
+                wait = self.reset_at - time.time()
+                if wait > 0:
+                    raise GitHubAPIError(429, f"GitHub API chỉ còn {self.remaining} request, thử lại sau {int(wait)} giây")
+                self.remaining = None
+            
+            if self.tokens >= 1:
+                self.tokens -= 1
+                if self.remaining is not None:
+                    self.remaining -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def update(self, status, headers):
+        """Cập nhật giới hạn còn lại từ header của response"""
+        if 'X-RateLimit-Remaining' in headers:
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            metrics.set('github_ratelimit_remaining', self.remaining)
+        if 'X-RateLimit-Reset' in headers:
+            self.reset_at = float(headers['X-RateLimit-Reset'])
+        # Secondary rate limit: GitHub yêu cầu chờ Retry-After giây
+        if status in (403, 429) and 'Retry-After' in headers:
+            self.remaining = 0
+            self.reset_at = time.time() + float(headers['Retry-After'])
+
+class GitHubJsonBackend(KeyBackend):
+    """Lưu key trong một file JSON trên GitHub (qua Contents API)"""
+    def __init__(self, github_token, repo_name, max_retries=COMMIT_MAX_RETRIES):
+        self.repo_name = repo_name
+        self.max_retries = max_retries
+        # URL của repo chỉ tính một lần, không cần gọi get_repo mỗi lệnh
+        self.contents_url = f"{GITHUB_API_URL}/repos/{repo_name}/contents"
+        self.headers = {
+            "Authorization": f"token {github_token}",
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+        self.session = None
+        self.snapshot = None
+        self.rate_limiter = GitHubRateLimiter()
+        # Các lần tải đang chạy theo đường dẫn: lệnh đọc cùng lúc dùng chung một request
+        self._inflight = {}
+        self.write_lock = asyncio.Lock()
+        self._compact_event = asyncio.Event()
+        self._compact_task = None
+    
+    async def start(self):
+        """Mở connection pool keep-alive dùng chung cho mọi lệnh"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=GITHUB_POOL_SIZE, keepalive_timeout=60, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=GITHUB_TIMEOUT)
+        if OPLOG_ENABLED and self._compact_task is None:
+            self._compact_task = asyncio.create_task(self._compact_loop())
+    
+    async def close(self):
+        """Đóng connection pool khi bot tắt"""
+        if self._compact_task is not None:
+            self._compact_task.cancel()
+            self._compact_task = None
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+    
+    def invalidate(self):
+        """Đánh dấu snapshot đã cũ: lần đọc sau revalidate bằng ETag (304 nếu chưa đổi)"""
+        if self.snapshot is not None:
+            self.snapshot.fetched_at = float('-inf')
+    
+    def cached(self):
+        return self.snapshot.store if self.snapshot is not None else None
+    
+    async def _get_contents(self, path, etag=None, write=False):
+        """Đọc file qua GitHub Contents API, trả về (nội dung, sha, etag) hoặc None nếu 304.
+        
+        write=True khi đọc để sửa rồi ghi: được dùng cả phần request dự trữ cho ghi.
+        """
+        url = f"{self.contents_url}/{path}"
+        headers = {"If-None-Match": etag} if etag else {}
+        await self.rate_limiter.acquire(write=write)
+        started = time.perf_counter()
+        async with self.session.get(url, headers=headers) as resp:
+            self.rate_limiter.update(resp.status, resp.headers)
+            body = await resp.read()
+            self._track('GET', resp.status, started, received=len(body))
+            if resp.status == 304:
+                return None
+            if resp.status != 200:
+                raise GitHubAPIError(resp.status, body.decode(errors='replace'))
+            data = loads_json(body)
+            new_etag = resp.headers.get('ETag')
+        
+        if data.get('encoding') == 'base64':
+            return base64.b64decode(data['content']), data['sha'], new_etag
+        
+        # File > 1MB: Contents API không trả content, phải lấy bản raw
+        await self.rate_limiter.acquire(write=write)
+        started = time.perf_counter()
+        async with self.session.get(url, headers={"Accept": "application/vnd.github.raw"}) as resp:
+            self.rate_limiter.update(resp.status, resp.headers)
+            body = await resp.read()
+            self._track('GET', resp.status, started, received=len(body))
+            if resp.status != 200:
+                raise GitHubAPIError(resp.status, body.decode(errors='replace'))
+            return body, data['sha'], new_etag
+    
+    async def _put_contents(self, path, content, sha, message):
+        """Ghi file qua GitHub Contents API, trả về sha mới"""
+        payload = {
+            "message": message,
+            "content": base64.b64encode(content).decode(),
+        }
+        if sha:
+            payload["sha"] = sha
+        body = dumps_json(payload)
+        await self.rate_limiter.acquire(write=True)
+        started = time.perf_counter()
+        async with self.session.put(f"{self.contents_url}/{path}", data=body, headers={"Content-Type": "application/json"}) as resp:
+            self.rate_limiter.update(resp.status, resp.headers)
+            response = await resp.read()
+            self._track('PUT', resp.status, started, sent=len(body), received=len(response))
+            if resp.status not in (200, 201):
+                raise GitHubAPIError(resp.status, response.decode(errors='replace'))
+        return loads_json(response)['content']['sha']
+    
+    def _track(self, method, status, started, sent=0, received=0):
+        """Ghi số liệu một request GitHub"""
+        metrics.observe('github_request_seconds', time.perf_counter() - started, method=method)
+        metrics.inc('github_requests_total', method=method, status=str(status))
+        if sent:
+            metrics.inc('github_bytes_total', sent, direction='out')
+        if received:
+            metrics.inc('github_bytes_total', received, direction='in')
+    
+    async def _fetch_snapshot(self, path, snapshot, write=False):
+        """Tải lại file JSON bằng conditional request, chỉ parse khi file thực sự đổi.
+        
+        Trả về (snapshot, có phải bản mới không).
+        """
+        result = await self._get_contents(path, etag=snapshot.etag if snapshot else None, write=write)
+        if result is not None and snapshot and snapshot.sha == result[1]:
+            snapshot.etag = result[2]
+            result = None
+        
+        if result is not None:
+            content, sha, etag = result
+            with metrics.timer('keystore_parse_seconds'):
+                snapshot = KeySnapshot(KeyStore(loads_json(content)), sha, etag)
+        snapshot.fetched_at = time.monotonic()
+        return snapshot, result is not None
+    
+    def _encode(self, store):
+        with metrics.timer('keystore_encode_seconds'):
+            return dumps_json(store.to_list(), pretty=not JSON_COMPACT)
+    
+    async def _single_flight(self, name, factory):
+        """Chạy factory() một lần cho mọi lời gọi cùng name đang chờ đồng thời"""
+        task = self._inflight.get(name)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[name] = task
+            task.add_done_callback(lambda _: self._inflight.pop(name, None))
+        # shield: một lệnh bị hủy không làm hủy request của các lệnh khác
+        return await asyncio.shield(task)
+    
+    async def _refresh_snapshot(self, write=False):
+        """Tải lại JSON (và op log nếu bật), dùng chung request nếu đang có lần tải khác.
+        
+        Lần tải cho ghi chạy riêng để không hỏng theo lần đọc bị chặn bởi phần dự trữ.
+        """
+        return await self._single_flight((JSON_FILE_PATH, write), lambda: self._reload_snapshot(write))
+    
+    async def _reload_snapshot(self, write=False):
+        snapshot, fresh = await self._fetch_snapshot(JSON_FILE_PATH, self.snapshot, write)
+        if OPLOG_ENABLED and not await self._replay_log(snapshot, fresh, write):
+            # Log bị ghi lại từ đầu trong khi file chính không đổi: tải lại toàn bộ
+            self.snapshot = None
+            return await self._reload_snapshot(write)
+        
+        self.snapshot = snapshot
+        return snapshot
+    
+    async def _replay_log(self, snapshot, fresh, write=False):
+        """Áp dụng phần op log chưa có trong snapshot. Trả về False nếu log không còn nối tiếp"""
+        try:
+            result = await self._get_contents(OPLOG_FILE_PATH, etag=None if fresh else snapshot.log_etag, write=write)
+        except GitHubAPIError as e:
+            if e.status != 404:
+                raise
+            result = (b'', None, None)
+        if result is None:
+            return True
+        
+        content, sha, etag = result
+        if fresh:
+            tail = content
+        elif content.startswith(snapshot.log_bytes):
+            tail = content[len(snapshot.log_bytes):]
+        else:
+            return False
+        
+        snapshot.store.apply_log(tail)
+        snapshot.log_bytes, snapshot.log_sha, snapshot.log_etag = content, sha, etag
+        return True
+    
+    async def load(self):
+        """Lấy KeyStore từ bộ nhớ cho lệnh chỉ đọc (không được sửa dữ liệu trả về)"""
+        try:
+            if self.snapshot is None or not self.snapshot.is_fresh():
+                await self._refresh_snapshot()
+            return self.snapshot.store
         except Exception as e:
             print(f"⚠️ Lỗi khi get JSON: {e}")
-            return []
+            return self.snapshot.store if self.snapshot else KeyStore()
+    
+    async def get(self, key):
+        return (await self.load()).get(key)
+    
+    async def query(self, key_type=None, hwid=None, expires_before=None, expires_after=None, limit=None,
+                    prefix=None, activated=None):
+        store = await self.load()
+        return store.query(key_type, hwid, expires_before, expires_after, limit, prefix, activated)
+    
+    async def apply(self, ops, keys=None):
+        """Áp dụng ops lên bản sao mới nhất rồi ghi một commit.
+        
+        Nếu sha bị thay đổi bởi người khác (409/422) thì tải lại và áp dụng
+        lại toàn bộ, tối đa max_retries lần.
+        """
+        async with self.write_lock:
+            for attempt in range(self.max_retries + 1):
+                snapshot = self.snapshot
+                if attempt > 0 or snapshot is None or not snapshot.is_fresh():
+                    snapshot = await self._refresh_snapshot(write=True)
+                
+                store = snapshot.store.copy()
+                store.track_changes()
+                results = run_ops(store, ops)
+                
+                if any(error is None for _, error in results):
+                    try:
+                        await self.write_changes(store, snapshot)
+                    except GitHubAPIError as e:
+                        if e.status in (409, 422) and attempt < self.max_retries:
+                            print(f"🔁 Xung đột sha, thử lại lần {attempt + 1}...")
+                            continue
+                        raise
+                return results
+    
+    async def archive(self, key_objs):
+        """Ghi thêm các key vào EXPIRED_ARCHIVE_PATH (JSON Lines)"""
+        archived_at = datetime.datetime.utcnow().isoformat()
+        lines = b''.join(dumps_json(dict(key_obj, archived_at=archived_at)) + b'\n' for key_obj in key_objs)
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                content, sha, _ = await self._get_contents(EXPIRED_ARCHIVE_PATH, write=True)
+            except GitHubAPIError as e:
+                if e.status != 404:
+                    raise
+                content, sha = b'', None
+            try:
+                await self._put_contents(EXPIRED_ARCHIVE_PATH, content + lines, sha, "Archive expired keys")
+                return
+            except GitHubAPIError as e:
+                if e.status not in (409, 422) or attempt == self.max_retries:
+                    raise
     
-    async def update_json(self, new_data):
-        """Cập nhật JSON lên GitHub"""
+    async def load_admins(self):
+        """Đọc ADMINS_FILE_PATH, trả về frozenset ID hoặc None nếu chưa có file"""
         try:
-            contents = self.repo.get_contents(JSON_FILE_PATH)
-            new_json = json.dumps(new_data, indent=2, ensure_ascii=False)
-            self.repo.update_file(contents.path, "Update keys", new_json, contents.sha)
-            return True
+            content, _, _ = await self._get_contents(ADMINS_FILE_PATH)
+        except GitHubAPIError as e:
+            if e.status != 404:
+                raise
+            return None
+        return frozenset(loads_json(content))
+    
+    async def update_admins(self, change, seed):
+        """Đọc - sửa - ghi ADMINS_FILE_PATH, thử lại khi sha bị đổi"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                content, sha, _ = await self._get_contents(ADMINS_FILE_PATH, write=True)
+                admins = set(loads_json(content))
+            except GitHubAPIError as e:
+                if e.status != 404:
+                    raise
+                admins, sha = set(seed), None
+            change(admins)
+            try:
+                await self._put_contents(ADMINS_FILE_PATH, dumps_json(sorted(admins), pretty=True), sha, "Update admins")
+                return frozenset(admins)
+            except GitHubAPIError as e:
+                if e.status not in (409, 422) or attempt == self.max_retries:
+                    raise
+    
+    async def update_json(self, new_data, sha):
+        """Ghi KeyStore lên GitHub đè lên phiên bản sha"""
+        new_sha = await self._put_contents(JSON_FILE_PATH, self._encode(new_data), sha, "Update keys")
+        # ETag mới chưa biết, lần revalidate sau sẽ tải lại đầy đủ
+        self.snapshot = KeySnapshot(new_data, new_sha, None)
+    
+    async def write_changes(self, store, snapshot):
+        """Ghi các thay đổi của store: thêm vào op log, hoặc ghi lại cả file nếu tắt op log"""
+        changes, store.changes = store.changes, None
+        if not OPLOG_ENABLED:
+            await self.update_json(store, snapshot.sha)
+            return
+        
+        lines = []
+        for key, key_obj in changes.items():
+            record = {"op": "upsert", "data": key_obj} if key_obj is not None else {"op": "delete", "key": key}
+            lines.append(dumps_json(record))
+        new_log = snapshot.log_bytes + b'\n'.join(lines) + b'\n'
+        
+        log_sha = await self._put_contents(OPLOG_FILE_PATH, new_log, snapshot.log_sha, "Append key log")
+        new_snapshot = KeySnapshot(store, snapshot.sha, snapshot.etag)
+        new_snapshot.log_bytes, new_snapshot.log_sha = new_log, log_sha
+        self.snapshot = new_snapshot
+        
+        if len(new_log) > OPLOG_MAX_BYTES:
+            self._compact_event.set()
+    
+    async def compact(self):
+        """Gộp op log vào JSON_FILE_PATH rồi làm rỗng log"""
+        async with self.write_lock:
+            snapshot = await self._refresh_snapshot(write=True)
+            if not snapshot.log_bytes:
+                return
+            
+            sha = await self._put_contents(JSON_FILE_PATH, self._encode(snapshot.store), snapshot.sha, "Compact keys")
+            # Nếu dừng giữa hai lần ghi, log cũ được áp dụng lại lần nữa: upsert/delete
+            # theo trạng thái cuối nên không sai dữ liệu
+            log_sha = await self._put_contents(OPLOG_FILE_PATH, b'', snapshot.log_sha, "Compact key log")
+            
+            new_snapshot = KeySnapshot(snapshot.store, sha, None)
+            new_snapshot.log_sha = log_sha
+            self.snapshot = new_snapshot
+            print(f"🗜️ Đã gộp op log ({len(snapshot.log_bytes)} bytes) vào {JSON_FILE_PATH}")
+    
+    async def _compact_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._compact_event.wait(), OPLOG_COMPACT_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._compact_event.clear()
+            try:
+                await self.compact()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi gộp op log: {e}")
+
+class ShardedGitHubBackend(GitHubJsonBackend):
+    """Chia key ra nhiều file JSON trên GitHub theo shard_of(key).
+    
+    SHARD_DIR/manifest.json ghi số shard và cách tính để loader tìm đúng file
+    SHARD_DIR/<shard>.json. Lệnh thao tác trên vài key chỉ đọc/ghi các shard
+    chứa các key đó.
+    """
+    def __init__(self, github_token, repo_name, shard_dir, shards, max_retries=COMMIT_MAX_RETRIES):
+        super().__init__(github_token, repo_name, max_retries)
+        self.shard_dir = shard_dir
+        self.shards = shards
+        self.shard_snapshots = {}
+        self._merged = None
+        self._merged_shas = None
+        # Chưa đọc/ghi được manifest thì chưa chắc dữ liệu đã chia shard: từ chối ghi
+        self.migrated = False
+    
+    @property
+    def manifest_path(self):
+        return f"{self.shard_dir}/manifest.json"
+    
+    def shard_path(self, shard_id):
+        return f"{self.shard_dir}/{shard_id:02x}.json"
+    
+    def invalidate(self):
+        super().invalidate()
+        for snapshot in self.shard_snapshots.values():
+            snapshot.fetched_at = float('-inf')
+    
+    def cached(self):
+        return self._merged
+    
+    async def start(self):
+        await super().start()
+        try:
+            await self._load_manifest()
         except Exception as e:
-            print(f"❌ Lỗi update GitHub: {e}")
-            return False
+            print(f"⚠️ Lỗi khi đọc manifest shard, tạm từ chối ghi cho tới khi đọc được: {e}")
+    
+    async def _load_manifest(self, write=False):
+        try:
+            content, _, _ = await self._get_contents(self.manifest_path, write=write)
+        except GitHubAPIError as e:
+            if e.status != 404:
+                raise
+            await self._migrate()
+        else:
+            self.shards = loads_json(content)['shards']
+            print(f"🧩 Đang dùng {self.shards} shard trong {self.shard_dir}/")
+        self.migrated = True
+    
+    async def _ensure_migrated(self):
+        """Thử đọc lại manifest nếu lúc start() chưa được; vẫn lỗi thì không cho ghi"""
+        if self.migrated:
+            return
+        try:
+            await self._load_manifest(write=True)
+        except Exception as e:
+            raise CommitError(f"Chưa đọc được manifest shard, không thể ghi: {e}") from e
+    
+    async def _migrate(self):
+        """Lần đầu bật sharding: chia JSON_FILE_PATH ra các shard rồi ghi manifest"""
+        try:
+            content, _, _ = await self._get_contents(JSON_FILE_PATH, write=True)
+            keys = loads_json(content)
+        except GitHubAPIError as e:
+            if e.status != 404:
+                raise
+            keys = []
+        
+        parts = defaultdict(list)
+        for key_obj in keys:
+            parts[shard_of(key_obj['key'], self.shards)].append(key_obj)
+        for shard_id in range(self.shards):
+            snapshot = await self._refresh_shard(shard_id, force=True, write=True)
+            if snapshot.sha is not None:
+                # shard đã có (lần chia trước ghi dở): giữ nguyên, không ghi đè
+                continue
+            store = KeyStore(parts[shard_id])
+            sha = await self._put_contents(self.shard_path(shard_id), self._encode(store), snapshot.sha, "Split keys into shards")
+            self.shard_snapshots[shard_id] = KeySnapshot(store, sha, None)
+        
+        manifest = {"version": 1, "shards": self.shards, "hash": "sha256", "hex_prefix": 8, "file": "{shard:02x}.json"}
+        await self._put_contents(self.manifest_path, dumps_json(manifest, True), None, "Add key shard manifest")
+        print(f"🧩 Đã chia {len(keys)} keys ra {self.shards} shard trong {self.shard_dir}/")
+    
+    async def _refresh_shard(self, shard_id, force=False, write=False):
+        snapshot = self.shard_snapshots.get(shard_id)
+        if not force and snapshot is not None and snapshot.is_fresh():
+            return snapshot
+        return await self._single_flight((self.shard_path(shard_id), write), lambda: self._reload_shard(shard_id, write))
+    
+    async def _reload_shard(self, shard_id, write=False):
+        snapshot = self.shard_snapshots.get(shard_id)
+        try:
+            snapshot, _ = await self._fetch_snapshot(self.shard_path(shard_id), snapshot, write)
+        except GitHubAPIError as e:
+            if e.status != 404:
+                raise
+            snapshot = KeySnapshot(KeyStore(), None, None)
+        self.shard_snapshots[shard_id] = snapshot
+        return snapshot
+    
+    async def _refresh_shards(self, shard_ids, force=False, write=False):
+        snapshots = await asyncio.gather(*(self._refresh_shard(i, force, write) for i in shard_ids))
+        return dict(zip(shard_ids, snapshots))
+    
+    async def load(self):
+        """Gộp tất cả shard thành một KeyStore (chỉ dựng lại khi có shard đổi)"""
+        try:
+            snapshots = await self._refresh_shards(range(self.shards))
+        except Exception as e:
+            print(f"⚠️ Lỗi khi get JSON: {e}")
+            if self._merged is None:
+                return KeyStore()
+            return self._merged
+        
+        shas = tuple(snapshots[i].sha for i in range(self.shards))
+        if self._merged is None or shas != self._merged_shas:
+            self._merged = KeyStore(key_obj for i in range(self.shards) for key_obj in snapshots[i].store)
+            self._merged_shas = shas
+        return self._merged
+    
+    async def get(self, key):
+        snapshot = await self._refresh_shard(shard_of(key, self.shards))
+        return snapshot.store.get(key)
+    
+    async def apply(self, ops, keys=None):
+        """Áp dụng ops lên các shard liên quan, mỗi shard thay đổi là một commit"""
+        async with self.write_lock:
+            await self._ensure_migrated()
+            shard_ids = set(range(self.shards)) if keys is None else {shard_of(k, self.shards) for k in keys}
+            for attempt in range(self.max_retries + 1):
+                snapshots = await self._refresh_shards(sorted(shard_ids), force=attempt > 0, write=True)
+                store = KeyStore(key_obj.copy() for i in sorted(shard_ids) for key_obj in snapshots[i].store)
+                store.track_changes()
+                results = run_ops(store, ops)
+                
+                touched = {shard_of(k, self.shards) for k in store.changes}
+                if touched - shard_ids:
+                    # op sửa key ngoài danh sách khai báo: nạp thêm shard rồi chạy lại
+                    shard_ids |= touched
+                    continue
+                
+                if any(error is None for _, error in results):
+                    try:
+                        await self._write_shards(store.changes, snapshots)
+                    except PartialCommitError as e:
+                        e.results = results
+                        raise
+                    except GitHubAPIError as e:
+                        if e.status in (409, 422) and attempt < self.max_retries:
+                            print(f"🔁 Xung đột sha, thử lại lần {attempt + 1}...")
+                            continue
+                        raise
+                return results
+            raise CommitError("Không áp dụng được thay đổi sau nhiều lần thử")
+    
+    async def _write_shards(self, changes, snapshots):
+        """Ghi thay đổi vào từng shard.
+        
+        Lỗi ở shard đầu tiên được ném ra (chưa ghi gì, apply() chạy lại toàn bộ ops
+        nếu là xung đột). Khi đã có shard ghi xong, các shard còn lại được tải lại và
+        ghi đè theo từng key (key ghi sau thắng), thử lại với thời gian chờ tăng dần
+        khi lỗi tạm thời. Shard vẫn không ghi được thì ném PartialCommitError cho
+        biết key nào đã ghi, key nào chưa.
+        """
+        by_shard = defaultdict(dict)
+        for key, key_obj in changes.items():
+            by_shard[shard_of(key, self.shards)][key] = key_obj
+        
+        outcome = {}
+        for shard_id, shard_changes in sorted(by_shard.items()):
+            snapshot = snapshots[shard_id]
+            delay = 1.0
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if snapshot is None:
+                        snapshot = await self._refresh_shard(shard_id, force=True, write=True)
+                    store = snapshot.store.copy()
+                    for key, key_obj in shard_changes.items():
+                        if key_obj is None:
+                            store.remove(key)
+                        else:
+                            store.add(key_obj)
+                    sha = await self._put_contents(self.shard_path(shard_id), self._encode(store), snapshot.sha, "Update keys")
+                except (GitHubAPIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if not outcome:
+                        raise
+                    if not is_transient(e) or attempt == self.max_retries:
+                        print(f"❌ Không ghi được shard {shard_id:02x} sau {attempt + 1} lần: {e}")
+                        outcome[shard_id] = e
+                        break
+                    if not (isinstance(e, GitHubAPIError) and e.status in (409, 422)):
+                        print(f"⚠️ Lỗi khi ghi shard {shard_id:02x}, thử lại sau {delay:.0f}s: {e}")
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, 30)
+                    # Tải lại shard trước khi ghi lại: lần ghi lỗi có thể đã tới GitHub
+                    snapshot = None
+                else:
+                    self.shard_snapshots[shard_id] = KeySnapshot(store, sha, None)
+                    outcome[shard_id] = None
+                    break
+        
+        failed_shards = [shard_id for shard_id, error in outcome.items() if error is not None]
+        if failed_shards:
+            written = {key for shard_id, error in outcome.items() if error is None for key in by_shard[shard_id]}
+            failed = {key for shard_id in failed_shards for key in by_shard[shard_id]}
+            message = (f"Đã ghi {len(outcome) - len(failed_shards)}/{len(outcome)} shard, chưa ghi shard "
+                       f"{', '.join(f'{shard_id:02x}' for shard_id in failed_shards)}: {outcome[failed_shards[0]]}")
+            raise PartialCommitError(message, written, failed, outcome)
+
+class SQLiteKeyView:
+    """Giao diện giống KeyStore trên một transaction SQLite, dùng cho op(store)"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.changes = {}
+        self._next_pos = conn.execute("SELECT COALESCE(MAX(pos), 0) + 1 FROM keys").fetchone()[0]
+    
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def get(self, key):
+        row = self.conn.execute("SELECT data FROM keys WHERE key = ?", (key,)).fetchone()
+        return loads_json(row[0]) if row else None
+    
+    def _write(self, key_obj):
+        expires = key_obj.get('expires')
+        self.conn.execute(
+            "INSERT INTO keys (key, pos, type, hwid, expires_at, data) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET type = excluded.type, hwid = excluded.hwid, "
+            "expires_at = excluded.expires_at, data = excluded.data",
+            (key_obj['key'], self._next_pos, key_obj.get('type'), key_obj.get('hwid', ''),
+             expiry_ts(parse_expiry(expires)) if expires else None,
+             dumps_json(key_obj).decode()),
+        )
+        self._next_pos += 1
+        self.changes[key_obj['key']] = key_obj
+    
+    def add(self, key_obj):
+        self._write(key_obj)
+    
+    def add_many(self, key_objs):
+        for key_obj in key_objs:
+            self._write(key_obj)
+    
+    def update(self, key, **fields):
+        key_obj = self.get(key)
+        if key_obj is None:
+            raise KeyError(key)
+        key_obj.update(fields)
+        self._write(key_obj)
+        return key_obj
+    
+    def update_many(self, updates):
+        return [self.update(key, **fields) for key, fields in updates.items()]
+    
+    def remove(self, key):
+        key_obj = self.get(key)
+        if key_obj is not None:
+            self.conn.execute("DELETE FROM keys WHERE key = ?", (key,))
+            self.changes[key] = None
+        return key_obj
+    
+    def remove_many(self, keys):
+        deleted, not_found = [], []
+        for key in dict.fromkeys(keys):
+            if self.remove(key) is not None:
+                deleted.append(key)
+            else:
+                not_found.append(key)
+        return deleted, not_found
+    
+    def expiry_of(self, key):
+        key_obj = self.get(key)
+        if key_obj is None or not key_obj.get('expires'):
+            return None
+        return parse_expiry(key_obj['expires'])
+
+class SQLiteBackend(KeyBackend):
+    """Lưu key trong SQLite cục bộ, có index theo key, type, hwid và expires"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS keys (
+            key TEXT PRIMARY KEY,
+            pos INTEGER NOT NULL,
+            type TEXT,
+            hwid TEXT NOT NULL DEFAULT '',
+            expires_at REAL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_keys_pos ON keys (pos);
+        CREATE INDEX IF NOT EXISTS idx_keys_type ON keys (type);
+        CREATE INDEX IF NOT EXISTS idx_keys_hwid ON keys (hwid);
+        CREATE INDEX IF NOT EXISTS idx_keys_expires ON keys (expires_at);
+        CREATE TABLE IF NOT EXISTS archived_keys (
+            key TEXT NOT NULL,
+            archived_at TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_archived_key ON archived_keys (key);
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY
+        );
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        # sqlite3 là blocking: mọi truy vấn chạy trên một thread riêng
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._cache = None
+        self._data_version = None
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _open(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+    
+    async def start(self):
+        if self.conn is None:
+            await self._run(self._open)
+    
+    async def close(self):
+        if self.conn is not None:
+            await self._run(self.conn.close)
+            self.conn = None
+        self._executor.shutdown(wait=False)
+    
+    def _load_sync(self):
+        # data_version chỉ đổi khi connection khác ghi vào file
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._cache is None or version != self._data_version:
+            rows = self.conn.execute("SELECT data FROM keys ORDER BY pos")
+            self._cache = KeyStore(loads_json(data) for (data,) in rows)
+            self._data_version = version
+        return self._cache
+    
+    async def load(self):
+        try:
+            return await self._run(self._load_sync)
+        except Exception as e:
+            print(f"⚠️ Lỗi khi đọc SQLite: {e}")
+            return self._cache if self._cache is not None else KeyStore()
+    
+    def _get_sync(self, key):
+        row = self.conn.execute("SELECT data FROM keys WHERE key = ?", (key,)).fetchone()
+        return loads_json(row[0]) if row else None
+    
+    async def get(self, key):
+        return await self._run(self._get_sync, key)
+    
+    def cached(self):
+        return self._cache
+    
+    def _query_sync(self, key_type, hwid, expires_before, expires_after, limit, prefix, activated):
+        sql, params = "SELECT data FROM keys WHERE 1 = 1", []
+        if prefix:
+            # Khoảng [prefix, prefix kế tiếp) dùng được index khóa chính, khác với LIKE
+            sql += " AND key >= ? AND key < ?"
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        if activated is not None:
+            sql += " AND hwid != ''" if activated else " AND hwid = ''"
+        if key_type is not None:
+            sql += " AND type = ?"
+            params.append(key_type)
+        if hwid is not None:
+            sql += " AND hwid = ?"
+            params.append(hwid)
+        if expires_before is not None:
+            sql += " AND expires_at < ?"
+            params.append(expiry_ts(expires_before))
+        if expires_after is not None:
+            sql += " AND expires_at >= ?"
+            params.append(expiry_ts(expires_after))
+        if expires_before is not None or expires_after is not None:
+            sql += " ORDER BY expires_at, key"
+        elif prefix:
+            sql += " ORDER BY key"
+        else:
+            sql += " ORDER BY pos"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [loads_json(data) for (data,) in self.conn.execute(sql, params)]
+    
+    async def query(self, key_type=None, hwid=None, expires_before=None, expires_after=None, limit=None,
+                    prefix=None, activated=None):
+        return await self._run(self._query_sync, key_type, hwid, expires_before, expires_after, limit, prefix, activated)
+    
+    def _archive_sync(self, key_objs):
+        archived_at = datetime.datetime.utcnow().isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO archived_keys (key, archived_at, data) VALUES (?, ?, ?)",
+                [(k['key'], archived_at, dumps_json(k).decode()) for k in key_objs],
+            )
+    
+    async def archive(self, key_objs):
+        await self._run(self._archive_sync, key_objs)
+    
+    def _load_admins_sync(self):
+        admins = frozenset(user_id for (user_id,) in self.conn.execute("SELECT user_id FROM admins"))
+        return admins or None
+    
+    async def load_admins(self):
+        return await self._run(self._load_admins_sync)
+    
+    def _update_admins_sync(self, change, seed):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = self._load_admins_sync() or frozenset()
+            admins = set(current or seed)
+            change(admins)
+            self.conn.executemany("DELETE FROM admins WHERE user_id = ?", [(i,) for i in current - admins])
+            self.conn.executemany("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", [(i,) for i in admins])
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return frozenset(admins)
+    
+    async def update_admins(self, change, seed):
+        return await self._run(self._update_admins_sync, change, seed)
+    
+    def _apply_sync(self, ops):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            view = SQLiteKeyView(self.conn)
+            changes, results = {}, []
+            for op in ops:
+                # Savepoint riêng cho từng thao tác: thao tác lỗi không để lại thay đổi dở dang
+                self.conn.execute("SAVEPOINT op")
+                view.changes = {}
+                try:
+                    results.append((op(view), None))
+                    changes.update(view.changes)
+                except KeyOpError as e:
+                    self.conn.execute("ROLLBACK TO op")
+                    results.append((None, e))
+                self.conn.execute("RELEASE op")
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return results, changes
+    
+    async def apply(self, ops, keys=None):
+        results, changes = await self._run(self._apply_sync, ops)
+        # Cập nhật cache trên event loop (không sửa từ thread SQLite khi lệnh khác đang đọc)
+        if self._cache is not None:
+            apply_changes(self._cache, changes)
+        return results
+
+# Bảng đổi byte ngẫu nhiên -> ký tự key. Byte >= KEY_BYTE_LIMIT bị bỏ để
+# mỗi ký tự trong KEY_CHARS có xác suất như nhau.
+KEY_CHARS = string.ascii_uppercase + string.digits
+KEY_BYTE_LIMIT = 256 - 256 % len(KEY_CHARS)
+KEY_BYTE_TABLE = bytes(ord(KEY_CHARS[b % len(KEY_CHARS)]) for b in range(256))
+KEY_BYTE_REJECT = bytes(range(KEY_BYTE_LIMIT, 256))
+
+class HotKeyCache:
+    """LRU các key vừa tra cứu; key không tồn tại được lưu là None với TTL ngắn hơn"""
+    def __init__(self, size=VERIFY_CACHE_SIZE, ttl=VERIFY_CACHE_TTL, negative_ttl=VERIFY_NEGATIVE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+    
+    def get(self, key):
+        """Trả về (True, key_obj) nếu còn trong cache, ngược lại (False, None)"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        key_obj, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, key_obj
+    
+    def put(self, key, key_obj):
+        ttl = self.ttl if key_obj is not None else self.negative_ttl
+        self._entries[key] = (key_obj, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+    
+    def invalidate(self, keys=None):
+        """Xóa các key khỏi cache (keys=None -> xóa hết)"""
+        if keys is None:
+            self._entries.clear()
+            return
+        for key in keys:
+            self._entries.pop(key, None)
+
+class AuditLog:
+    """Lịch sử thay đổi key trong SQLite cục bộ, index theo key và theo người thực hiện.
+    
+    Mỗi sự kiện: thời điểm, người thực hiện, lệnh, key và các trường trước/sau
+    (chỉ những trường đã đổi; before None = tạo mới, after None = đã xóa).
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS audit_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            actor INTEGER,
+            command TEXT,
+            key TEXT NOT NULL,
+            before TEXT,
+            after TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_audit_key ON audit_events (key, id);
+        CREATE INDEX IF NOT EXISTS idx_audit_actor ON audit_events (actor, id);
+        CREATE INDEX IF NOT EXISTS idx_audit_ts ON audit_events (ts);
+    """
+    
+    def __init__(self, path, retention_days=AUDIT_RETENTION_DAYS, max_events=AUDIT_MAX_EVENTS):
+        self.path = path
+        self.retention_days = retention_days
+        self.max_events = max_events
+        self.conn = None
+        self._rotated_at = 0.0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit")
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _open(self):
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+    
+    async def start(self):
+        if self.conn is None:
+            await self._run(self._open)
+            await self.rotate()
+    
+    async def close(self):
+        if self.conn is not None:
+            await self._run(self.conn.close)
+            self.conn = None
+        self._executor.shutdown(wait=False)
+    
+    @staticmethod
+    def diff(before, after):
+        """Chỉ giữ các trường đã đổi khi key được sửa"""
+        if before is None or after is None:
+            return before, after
+        changed = [field for field in {**before, **after} if before.get(field) != after.get(field)]
+        return {f: before.get(f) for f in changed}, {f: after.get(f) for f in changed}
+    
+    def _record_sync(self, rows):
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT INTO audit_events (ts, actor, command, key, before, after) VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+    
+    async def record(self, actor, command, events):
+        """Ghi các sự kiện (key, trước, sau) của một lệnh"""
+        now = time.time()
+        rows = []
+        for key, before, after in events:
+            before, after = self.diff(before, after)
+            rows.append((now, actor, command, key,
+                         dumps_json(before).decode() if before is not None else None,
+                         dumps_json(after).decode() if after is not None else None))
+        with metrics.timer('audit_seconds', op='record'):
+            await self._run(self._record_sync, rows)
+        metrics.inc('audit_events_total', len(rows))
+        if time.monotonic() - self._rotated_at >= AUDIT_ROTATE_INTERVAL:
+            await self.rotate()
+    
+    def _rotate_sync(self):
+        deleted = self.conn.execute(
+            "DELETE FROM audit_events WHERE ts < ?", (time.time() - self.retention_days * 86400,)
+        ).rowcount
+        deleted += self.conn.execute(
+            "DELETE FROM audit_events WHERE id <= (SELECT MAX(id) FROM audit_events) - ?", (self.max_events,)
+        ).rowcount
+        return deleted
+    
+    async def rotate(self):
+        """Xóa sự kiện quá hạn lưu giữ hoặc vượt quá số lượng tối đa"""
+        self._rotated_at = time.monotonic()
+        deleted = await self._run(self._rotate_sync)
+        if deleted:
+            print(f"🧹 Đã dọn {deleted} sự kiện lịch sử cũ")
+        return deleted
+    
+    def _query_sync(self, column, value, limit):
+        rows = self.conn.execute(
+            f"SELECT ts, actor, command, key, before, after FROM audit_events WHERE {column} = ? ORDER BY id DESC LIMIT ?",
+            (value, limit),
+        ).fetchall()
+        return [
+            {"ts": ts, "actor": actor, "command": command, "key": key,
+             "before": loads_json(before) if before is not None else None,
+             "after": loads_json(after) if after is not None else None}
+            for ts, actor, command, key, before, after in rows
+        ]
+    
+    async def history(self, key, limit=20):
+        """Các sự kiện mới nhất của một key"""
+        with metrics.timer('audit_seconds', op='query'):
+            return await self._run(self._query_sync, 'key', key, limit)
+    
+    async def by_actor(self, actor, limit=20):
+        """Các sự kiện mới nhất do một người thực hiện"""
+        with metrics.timer('audit_seconds', op='query'):
+            return await self._run(self._query_sync, 'actor', actor, limit)
+
+class WriteAheadJournal:
+    """Journal append-only trên đĩa cục bộ.
+    
+    Mỗi dòng {"seq", "changes"} ghi trạng thái cuối của các key mà một lệnh
+    đã sửa (key -> dữ liệu, None = đã xóa) và được fsync trước khi lệnh trả
+    lời. pending là các entry (seq, changes) chưa đẩy lên backend; áp dụng lại
+    một entry đã đẩy rồi không làm sai dữ liệu.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pending = []
+        self._seq = 0
+        self._file = None
+        self._lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    @staticmethod
+    def _encode(seq, changes):
+        return dumps_json({"seq": seq, "changes": changes}) + b'\n'
+    
+    def _open_sync(self):
+        entries, torn = [], False
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = loads_json(line)
+                    except ValueError:
+                        # Dòng cuối ghi dở khi tiến trình chết: lệnh đó chưa được trả lời
+                        torn = True
+                        break
+                    entries.append((entry['seq'], entry['changes']))
+        if torn:
+            self._rewrite_sync(entries)
+        else:
+            self._file = open(self.path, 'ab')
+        return entries
+    
+    def _append_sync(self, line):
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+    
+    def _rewrite_sync(self, entries):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for seq, changes in entries:
+                f.write(self._encode(seq, changes))
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'ab')
+    
+    async def open(self):
+        """Mở journal, trả về các entry chưa đẩy lên backend từ lần chạy trước"""
+        async with self._lock:
+            if self._file is None:
+                self.pending = await self._run(self._open_sync)
+                self._seq = self.pending[-1][0] if self.pending else 0
+                metrics.set('journal_pending', len(self.pending))
+        return self.pending
+    
+    async def close(self):
+        async with self._lock:
+            if self._file is not None:
+                await self._run(self._file.close)
+                self._file = None
+        self._executor.shutdown(wait=False)
+    
+    async def append(self, changes):
+        """Ghi và fsync một entry, chỉ trả về khi dữ liệu đã nằm trên đĩa"""
+        async with self._lock:
+            seq = self._seq + 1
+            with metrics.timer('journal_fsync_seconds'):
+                await self._run(self._append_sync, self._encode(seq, changes))
+            self._seq = seq
+            self.pending.append((seq, changes))
+            metrics.set('journal_pending', len(self.pending))
+        return seq
+    
+    async def truncate(self, upto_seq):
+        """Bỏ các entry đã đẩy lên backend (seq <= upto_seq)"""
+        async with self._lock:
+            remaining = [entry for entry in self.pending if entry[0] > upto_seq]
+            await self._run(self._rewrite_sync, remaining)
+            self.pending = remaining
+            metrics.set('journal_pending', len(self.pending))
+
+class LeaseStore:
+    """Nơi lưu lease leader dùng chung giữa các replica.
+    
+    - acquire(holder, url, ttl): gia hạn nếu holder đang giữ lease, giành lease
+      nếu lease đã hết hạn; trả về lease hiện tại {holder, url, expires_at, version}
+    - bump(holder): tăng version sau mỗi commit, trả về version mới hoặc None
+      nếu holder không còn giữ lease
+    - release(holder): trả lease ngay khi tắt để replica khác khỏi chờ hết hạn
+    
+    Lớp con chỉ cần cài _transact(change): đọc lease, gọi change(lease) để sửa
+    tại chỗ rồi ghi lại, tất cả trong một khóa. Các hàm chạy đồng bộ (qua
+    asyncio.to_thread). File và SQLite chỉ dùng được khi các replica chung một
+    ổ đĩa; triển khai trên nhiều máy cần lớp con dùng Redis, Postgres...
+    """
+    def _transact(self, change):
+        raise NotImplementedError
+    
+    def acquire(self, holder, url, ttl):
+        def change(lease):
+            now = time.time()
+            if lease['holder'] != holder and lease['expires_at'] > now:
+                return dict(lease)
+            if lease['holder'] != holder:
+                # Leader mới: tăng version để follower bỏ cache của leader cũ
+                lease['version'] += 1
+            lease.update(holder=holder, url=url, expires_at=now + ttl)
+            return dict(lease)
+        return self._transact(change)
+    
+    def bump(self, holder):
+        def change(lease):
+            if lease['holder'] != holder or lease['expires_at'] <= time.time():
+                return None
+            lease['version'] += 1
+            return lease['version']
+        return self._transact(change)
+    
+    def release(self, holder):
+        def change(lease):
+            if lease['holder'] == holder:
+                lease['expires_at'] = 0
+        self._transact(change)
+
+def empty_lease():
+    return {'holder': None, 'url': None, 'expires_at': 0, 'version': 0}
+
+class FileLeaseStore(LeaseStore):
+    """Lease trong một file JSON, khóa bằng flock"""
+    def __init__(self, path):
+        self.path = path
+    
+    def _transact(self, change):
+        with open(self.path, 'a+b') as f:
+            # Khóa được nhả khi đóng file
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            lease = loads_json(content) if content.strip() else empty_lease()
+            result = change(lease)
+            f.seek(0)
+            f.truncate()
+            f.write(dumps_json(lease))
+            f.flush()
+            os.fsync(f.fileno())
+            return result
+
+class SQLiteLeaseStore(LeaseStore):
+    """Lease trong bảng leader_lease của một file SQLite"""
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leader_lease (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    holder TEXT,
+                    url TEXT,
+                    expires_at REAL NOT NULL,
+                    version INTEGER NOT NULL
+                )
+            """)
+    
+    def _connect(self):
+        # Mỗi lần một connection: được gọi từ nhiều thread của asyncio.to_thread
+        return sqlite3.connect(self.path, timeout=LEADER_LEASE_TTL, isolation_level=None)
+    
+    def _transact(self, change):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT holder, url, expires_at, version FROM leader_lease WHERE id = 1").fetchone()
+                lease = dict(zip(('holder', 'url', 'expires_at', 'version'), row)) if row else empty_lease()
+                result = change(lease)
+                conn.execute(
+                    "INSERT OR REPLACE INTO leader_lease (id, holder, url, expires_at, version) VALUES (1, ?, ?, ?, ?)",
+                    (lease['holder'], lease['url'], lease['expires_at'], lease['version']),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return result
+        finally:
+            conn.close()
+
+class LeaderElection:
+    """Bầu một replica làm leader bằng lease có hạn ttl giây.
+    
+    Mỗi replica gọi acquire sau mỗi ttl/3 giây: leader gia hạn lease, follower
+    giành lease khi leader ngừng gia hạn. Leader tăng version của lease sau mỗi
+    commit; follower thấy version đổi thì gọi on_version_change để bỏ cache.
+    """
+    def __init__(self, lease_store, replica_id=REPLICA_ID, url=REPLICA_URL, ttl=LEADER_LEASE_TTL):
+        self.lease_store = lease_store
+        self.replica_id = replica_id
+        self.url = url
+        self.ttl = ttl
+        self.is_leader = False
+        self.leader_id = None
+        self.leader_url = None
+        self.version = None
+        self.on_version_change = None
+        self._lease_until = 0.0
+        self._task = None
+    
+    async def start(self):
+        try:
+            await self._renew()
+        except Exception as e:
+            print(f"⚠️ Lỗi khi đọc lease leader: {e}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                await asyncio.to_thread(self.lease_store.release, self.replica_id)
+            except Exception as e:
+                print(f"⚠️ Lỗi khi trả lease leader: {e}")
+    
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self._renew()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi gia hạn lease leader: {e}")
+                # Không gia hạn được quá ttl thì replica khác có thể đã giành lease
+                if self.is_leader and time.monotonic() >= self._lease_until:
+                    self._set_leader(False)
+    
+    async def _renew(self):
+        started = time.monotonic()
+        lease = await asyncio.to_thread(self.lease_store.acquire, self.replica_id, self.url, self.ttl)
+        self.leader_id, self.leader_url = lease['holder'], lease['url']
+        was_leader = self.is_leader
+        if lease['holder'] == self.replica_id:
+            self._lease_until = started + self.ttl
+        self._set_leader(lease['holder'] == self.replica_id)
+        
+        previous = self.version
+        if was_leader and self.is_leader:
+            # Leader tự tăng version khi commit, bỏ qua bản đọc cũ hơn
+            self.version = max(previous or 0, lease['version'])
+        else:
+            self.version = lease['version']
+            if previous is not None and previous != self.version and self.on_version_change is not None:
+                await self.on_version_change()
+    
+    def _set_leader(self, is_leader):
+        if is_leader != self.is_leader:
+            print(f"👑 Replica {self.replica_id} {'trở thành leader' if is_leader else 'không còn là leader'}")
+        self.is_leader = is_leader
+        metrics.set('replica_is_leader', int(is_leader))
+    
+    async def committed(self):
+        """Leader gọi sau mỗi lần ghi để follower biết mà bỏ cache"""
+        version = await asyncio.to_thread(self.lease_store.bump, self.replica_id)
+        if version is None:
+            print(f"⚠️ Replica {self.replica_id} đã mất lease trong lúc ghi")
+            self._set_leader(False)
+        else:
+            self.version = version
+
+class KeyManager:
+    """Điểm truy cập dữ liệu key dùng chung cho mọi lệnh"""
+    def __init__(self, backend, election=None, journal=None, audit=None):
+        self.backend = backend
+        self.commit_queue = CommitQueue(backend)
+        self.hot_cache = HotKeyCache()
+        # Chạy nhiều replica: LeaderElection quyết định replica nào được ghi (None = luôn tự ghi)
+        self.election = election
+        self._forward_session = None
+        # Có journal: lệnh ghi trả lời sau khi fsync, _flush_task đẩy lên backend sau.
+        # _overlay = KeyStore của backend (_overlay_base) cộng các entry journal chưa đẩy
+        self.journal = journal
+        self._journal_lock = asyncio.Lock()
+        self._overlay_base = None
+        self._overlay = None
+        self._flush_event = asyncio.Event()
+        self._flush_task = None
+        # AuditLog ghi lịch sử thay đổi key (None = tắt)
+        self.audit = audit
+        self._sweep_task = None
+        # True khi start() chạy xong; nếu lỗi thì _start_task thử lại và lệnh ghi bị từ chối
+        self.started = False
+        self._start_task = None
+        # Được set khi warm_up() xong (kể cả khi lỗi); lệnh đến sớm sẽ chờ ở đây
+        self.ready = asyncio.Event()
+        # Tập admin trong bộ nhớ cho is_admin (frozenset, thay cả tập khi có thay đổi)
+        self.admins = ADMIN_IDS
+        self._admin_lock = asyncio.Lock()
+    
+    async def start(self):
+        """Khởi động backend, hàng đợi commit, journal, bầu leader và quét key hết hạn.
+        
+        Gọi lại được sau khi lỗi: bước nào đã xong thì bỏ qua.
+        """
+        await self.backend.start()
+        self.commit_queue.start()
+        if self.audit is not None:
+            # Lỗi audit log không chặn lệnh ghi, _record_audit sẽ thử mở lại
+            try:
+                await self.audit.start()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi mở audit log, tạm thời không ghi được lịch sử: {e}")
+        if self.journal is not None and self._flush_task is None:
+            replayed = await self.journal.open()
+            if replayed:
+                print(f"♻️ Journal còn {len(replayed)} thay đổi chưa đẩy lên backend, đang phát lại")
+                self._flush_event.set()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self.election is not None:
+            if self._forward_session is None:
+                self._forward_session = aiohttp.ClientSession(timeout=GITHUB_TIMEOUT, headers={"X-Replica-Secret": REPLICA_SECRET})
+            self.election.on_version_change = self._on_leader_commit
+            await self.election.start()
+        if EXPIRY_SWEEP_INTERVAL > 0 and self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+        self.started = True
+    
+    async def _retry_start(self):
+        """Thử start() lại với thời gian chờ tăng dần cho tới khi được"""
+        delay = 1.0
+        while not self.started:
+            await asyncio.sleep(delay)
+            try:
+                await self.start()
+                print("✅ Đã khởi động lại được, lệnh ghi hoạt động bình thường")
+            except Exception as e:
+                delay = min(delay * 2, 60)
+                print(f"⚠️ Vẫn chưa khởi động được, thử lại sau {delay:.0f}s: {e}")
+        self._start_task = None
+    
+    def _check_started(self):
+        if not self.started:
+            raise CommitError("Bot chưa khởi động xong phần ghi dữ liệu, thử lại sau")
+    
+    async def close(self):
+        if self._start_task is not None:
+            self._start_task.cancel()
+            self._start_task = None
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+        if self.election is not None:
+            await self.election.close()
+        if self._forward_session is not None:
+            await self._forward_session.close()
+            self._forward_session = None
+        if self._flush_task is not None:
+            # Entry chưa đẩy vẫn nằm trong journal, lần chạy sau sẽ phát lại
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.commit_queue.stop()
+        if self.journal is not None:
+            await self.journal.close()
+        if self.audit is not None:
+            await self.audit.close()
+        await self.backend.close()
+    
+    @property
+    def forwarding(self):
+        """True nếu replica này là follower: lệnh ghi phải chuyển tới leader"""
+        return self.election is not None and not self.election.is_leader
+    
+    async def _forward(self, method, **payload):
+        """Gửi lệnh ghi tới leader, raise KeyOpError/CommitError như khi ghi tại chỗ"""
+        leader_url = self.election.leader_url
+        if not leader_url:
+            raise CommitError("Chưa có leader để ghi dữ liệu")
+        actor, command = audit_context.get()
+        try:
+            with metrics.timer('forward_seconds', method=method):
+                async with self._forward_session.post(
+                    f"{leader_url}/internal/write",
+                    data=dumps_json(dict(payload, method=method, actor=actor, command=command)),
+                    headers={"Content-Type": "application/json"},
+                ) as resp:
+                    status, body = resp.status, loads_json(await resp.read())
+        except Exception as e:
+            print(f"❌ Lỗi khi chuyển lệnh ghi tới leader {leader_url}: {e}")
+            raise CommitError(str(e)) from e
+        metrics.inc('forwarded_writes_total', method=method, status=str(status))
+        if status == 409:
+            raise KeyOpError(body['error'])
+        if status != 200:
+            raise CommitError(body.get('error', f"Leader trả về HTTP {status}"))
+        # Đọc lại ngay thay đổi vừa ghi, không chờ vòng gia hạn lease
+        self.backend.invalidate()
+        return body['result']
+    
+    async def _on_leader_commit(self):
+        """Follower: leader vừa ghi dữ liệu, bỏ cache để lần đọc sau lấy bản mới"""
+        self.backend.invalidate()
+        self.hot_cache.invalidate()
+        try:
+            await self.load_admins()
+        except Exception as e:
+            print(f"⚠️ Lỗi khi nạp lại danh sách admin: {e}")
+    
+    async def _committed(self):
+        if self.election is not None:
+            try:
+                await self.election.committed()
+            except Exception as e:
+                print(f"⚠️ Lỗi khi báo commit cho follower: {e}")
+    
+    @staticmethod
+    def generate_keys(amount, existing=(), length=16):
+        """Tạo amount key ngẫu nhiên, không trùng nhau và không trùng key trong existing"""
+        keys, seen = [], set()
+        while len(keys) < amount:
+            # Lấy byte từ secrets theo lô, dư ra một chút để bù các byte bị bỏ
+            need = (amount - len(keys)) * length
+            chars = secrets.token_bytes(need + need // 16 + length).translate(KEY_BYTE_TABLE, KEY_BYTE_REJECT).decode()
+            for i in range(0, len(chars) - length + 1, length):
+                key = chars[i:i + length]
+                if key in seen or key in existing:
+                    continue
+                seen.add(key)
+                keys.append(key)
+                if len(keys) == amount:
+                    break
+        return keys
+    
+    async def warm_up(self):
+        """Khởi tạo backend và nạp sẵn KeyStore khi bot khởi động, log thời gian từng bước"""
+        started = time.perf_counter()
+        try:
+            stage = time.perf_counter()
+            await self.start()
+            print(f"⏱️ Warm-up khởi tạo backend + HTTP pool: {(time.perf_counter() - stage) * 1000:.0f} ms")
+        except Exception as e:
+            print(f"❌ Lỗi khi khởi động, lệnh ghi sẽ báo lỗi cho tới khi khởi động lại được: {e}")
+            if self._start_task is None:
+                self._start_task = asyncio.create_task(self._retry_start())
+        
+        try:
+            stage = time.perf_counter()
+            store = await self.backend.load()
+            print(f"⏱️ Warm-up tải + parse + index {len(store)} keys: {(time.perf_counter() - stage) * 1000:.0f} ms")
+            
+            stage = time.perf_counter()
+            store.stats()
+            print(f"⏱️ Warm-up thống kê: {(time.perf_counter() - stage) * 1000:.0f} ms")
+            
+            stage = time.perf_counter()
+            await self.load_admins()
+            print(f"⏱️ Warm-up danh sách {len(self.admins)} admin: {(time.perf_counter() - stage) * 1000:.0f} ms")
+        except Exception as e:
+            print(f"⚠️ Lỗi khi nạp sẵn dữ liệu, lệnh đầu tiên sẽ tự tải lại: {e}")
+        finally:
+            self.ready.set()
+            print(f"✅ Warm-up xong sau {(time.perf_counter() - started) * 1000:.0f} ms")
+    
+    async def get_cached_json(self):
+        """Lấy KeyStore cho lệnh chỉ đọc (không được sửa dữ liệu trả về)"""
+        await self.ready.wait()
+        with metrics.timer('storage_seconds', op='load'):
+            if self.journal is not None:
+                return await self._journal_view()
+            return await self.backend.load()
+    
+    def cached_store(self):
+        """KeyStore đang có trong bộ nhớ (có thể hơi cũ), None nếu chưa tải; không chờ I/O"""
+        if self.journal is not None and self._overlay is not None:
+            return self._overlay
+        return self.backend.cached()
+    
+    async def _journal_view(self):
+        """KeyStore của backend cộng các thay đổi trong journal chưa đẩy lên"""
+        base = await self.backend.load()
+        if base is not self._overlay_base:
+            # Dựng lại dưới _journal_lock để không chen vào giữa lúc một lệnh ghi đang fsync
+            async with self._journal_lock:
+                latest = self.backend.cached()
+                self._rebase_overlay(latest if latest is not None else base)
+        return self._overlay
+    
+    def _rebase_overlay(self, base):
+        """Dựng lại _overlay = base + các entry journal chưa đẩy (gọi khi giữ _journal_lock)"""
+        if base is self._overlay_base:
+            return
+        store = base
+        if self.journal.pending:
+            store = base.copy()
+            for _, changes in self.journal.pending:
+                apply_changes(store, changes)
+        self._overlay_base, self._overlay = base, store
+    
+    def _writable_overlay(self):
+        """_overlay để sửa tại chỗ, tách khỏi cache của backend nếu đang dùng chung"""
+        if self._overlay is self._overlay_base:
+            # Một lần mỗi khi backend tải lại, không phải mỗi lệnh ghi
+            self._overlay = self._overlay.copy()
+        return self._overlay
+    
+    async def _journal_submit(self, op):
+        """Chạy op(store) trên _overlay để lấy thay đổi, fsync vào journal rồi mới công bố.
+        
+        Op chạy thẳng trên _overlay (không copy cả store) rồi được hoàn tác ngay; thay đổi
+        chỉ được áp dụng lại sau khi journal đã fsync, nên lệnh đọc không thấy dữ liệu chưa
+        lưu. Toàn bộ chạy dưới _journal_lock, cùng khóa với lần dựng lại _overlay.
+        """
+        async with self._journal_lock:
+            self._rebase_overlay(await self.backend.load())
+            store = self._writable_overlay()
+            store.track_changes(undo=True)
+            try:
+                result = op(store)
+            except KeyOpError:
+                store.rollback()
+                raise
+            except Exception as e:
+                store.rollback()
+                print(f"❌ Lỗi khi ghi journal: {e}")
+                raise CommitError(str(e)) from e
+            # Bản sao: lệnh sau sửa tại chỗ các Key trong overlay, entry journal phải giữ nguyên
+            changes = {key: key_obj.copy() if key_obj is not None else None for key, key_obj in store.changes.items()}
+            store.rollback()
+            if not changes:
+                return result
+            try:
+                await self.journal.append(changes)
+            except Exception as e:
+                print(f"❌ Lỗi khi ghi journal: {e}")
+                raise CommitError(str(e)) from e
+            apply_changes(store, changes)
+            self._flush_event.set()
+        return result
+    
+    async def _flush_loop(self):
+        """Đẩy các entry journal lên backend, thử lại với thời gian chờ tăng dần khi lỗi.
+        
+        Replica đã thành follower thì chuyển các entry còn lại cho leader ghi.
+        """
+        audit_context.set((None, 'đẩy journal'))
+        delay = 1.0
+        while True:
+            await self._flush_event.wait()
+            self._flush_event.clear()
+            while self.journal.pending:
+                entries = list(self.journal.pending)
+                changes = {}
+                for _, entry_changes in entries:
+                    changes.update(entry_changes)
+                forwarded = self.forwarding
+                try:
+                    with metrics.timer('journal_flush_seconds'):
+                        if forwarded:
+                            await self._forward('submit', op='apply_changes', keys=list(changes), args={'changes': changes})
+                        else:
+                            await self.commit_queue.submit(functools.partial(apply_changes, changes=changes), set(changes))
+                    await self.journal.truncate(entries[-1][0])
+                except Exception as e:
+                    print(f"⚠️ Lỗi khi đẩy journal lên backend, thử lại sau {delay:.0f}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, JOURNAL_RETRY_MAX)
+                    continue
+                delay = 1.0
+                if not forwarded:
+                    # Lệnh chuyển tới leader thì leader tự báo commit
+                    await self._committed()
+    
+    async def submit(self, op, keys=None, **args):
+        """Thực hiện thay đổi qua hàng đợi commit, trả về kết quả của op.
+        
+        op: tên thao tác đăng ký bằng @write_op (chạy op(store, **args)), hoặc
+        hàm op(store) chỉ chạy được trên replica đang ghi.
+        keys: các key mà op đọc/sửa, giúp backend chia shard chỉ nạp phần cần thiết.
+        """
+        await self.ready.wait()
+        self._check_started()
+        try:
+            if self.forwarding:
+                if not isinstance(op, str):
+                    raise CommitError("Thao tác không có tên, không chuyển được tới leader")
+                return await self._forward('submit', op=op, keys=keys, args=args)
+            events = []
+            func = resolve_op(op, args)
+            if self.audit is not None and keys is not None:
+                func = audited(func, keys, events)
+            if self.journal is not None:
+                with metrics.timer('storage_seconds', op='journal'):
+                    result = await self._journal_submit(func)
+            else:
+                with metrics.timer('storage_seconds', op='commit'):
+                    result = await self.commit_queue.submit(func, keys)
+                await self._committed()
+            await self._record_audit(events)
+            return result
+        finally:
+            self.hot_cache.invalidate(keys)
+    
+    async def _record_audit(self, events):
+        """Ghi lịch sử sau khi thay đổi đã được lưu; lỗi ở đây không làm hỏng lệnh"""
+        if self.audit is None or not events:
+            return
+        actor, command = audit_context.get()
+        try:
+            await self.audit.start()
+            await self.audit.record(actor, command, events)
+        except Exception as e:
+            print(f"⚠️ Lỗi khi ghi lịch sử thay đổi: {e}")
+    
+    async def verify(self, key, hwid=''):
+        """Kiểm tra key cho loader, trả về dict kết quả (valid, reason, type, expires)"""
+        found, key_obj = self.hot_cache.get(key)
+        metrics.inc('verify_cache_total', result='hit' if found else 'miss')
+        if not found:
+            await self.ready.wait()
+            with metrics.timer('storage_seconds', op='get'):
+                if self.journal is not None:
+                    key_obj = (await self._journal_view()).get(key)
+                else:
+                    key_obj = await self.backend.get(key)
+            self.hot_cache.put(key, key_obj)
+        
+        if key_obj is None:
+            return {'valid': False, 'reason': 'not_found'}
+        
+        result = {'type': key_obj.get('type'), 'expires': key_obj.get('expires')}
+        if not key_obj.get('unlimited') and key_obj.get('expires'):
+            if parse_expiry(key_obj['expires']) < datetime.datetime.utcnow():
+                return dict(result, valid=False, reason='expired')
+        if key_obj.get('type') == 'single':
+            if not key_obj.get('hwid'):
+                return dict(result, valid=False, reason='not_activated')
+            if key_obj['hwid'] != hwid:
+                return dict(result, valid=False, reason='hwid_mismatch')
+        return dict(result, valid=True)
+    
+    async def load_admins(self):
+        """Nạp danh sách admin đã lưu (giữ ADMIN_IDS nếu backend chưa có)"""
+        admins = await self.backend.load_admins()
+        if admins is not None:
+            self.admins = admins
+        return self.admins
+    
+    async def update_admins(self, op, **args):
+        """Sửa tập admin bằng op(set, **args) (op là tên @write_op hoặc hàm), lưu vào
+        backend rồi mới áp dụng trong bộ nhớ.
+        
+        op có thể raise KeyOpError để từ chối thay đổi.
+        """
+        self._check_started()
+        if self.forwarding:
+            if not isinstance(op, str):
+                raise CommitError("Thao tác không có tên, không chuyển được tới leader")
+            self.admins = frozenset(await self._forward('update_admins', op=op, args=args))
+            return self.admins
+        
+        async with self._admin_lock:
+            try:
+                self.admins = await self.backend.update_admins(resolve_op(op, args), self.admins)
+            except KeyOpError:
+                raise
+            except Exception as e:
+                print(f"❌ Lỗi khi lưu danh sách admin: {e}")
+                raise CommitError(str(e)) from e
+        await self._committed()
+        return self.admins
+    
+    async def remove_expired(self, expired_keys):
+        """Lưu trữ rồi xóa các key trong expired_keys còn hết hạn lúc commit, trả về số key đã xóa"""
+        self._check_started()
+        if self.forwarding:
+            return await self._forward('remove_expired', expired_keys=expired_keys)
+        await self.backend.archive(expired_keys)
+        keys = [k['key'] for k in expired_keys]
+        return await self.submit('remove_expired_keys', keys=keys, names=keys)
+    
+    async def _sweep_loop(self):
+        audit_context.set((None, 'tự động xóa key hết hạn'))
+        while True:
+            await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+            if self.forwarding:
+                # Chỉ leader quét, follower không cần gửi lệnh xóa trùng
+                continue
+            try:
+                expired_keys = (await self.get_cached_json()).expired()
+                if expired_keys:
+                    count = await self.remove_expired(expired_keys)
+                    print(f"🧹 Đã tự động xóa {count} key hết hạn")
+            except Exception as e:
+                print(f"⚠️ Lỗi khi quét key hết hạn: {e}")
     
     def calculate_expiry_date(self, days=30):
         """Tính ngày hết hạn"""
         return (datetime.datetime.utcnow() + datetime.timedelta(days=days)).isoformat()
+
+def create_verify_app(manager):
+    """App aiohttp phục vụ GET /verify?key=&hwid="""
+    async def verify(request):
+        key = request.query.get('key')
+        if not key:
+            return web.json_response({'valid': False, 'reason': 'missing_key'}, status=400)
+        try:
+            with metrics.timer('verify_seconds'):
+                result = await manager.verify(key, request.query.get('hwid', ''))
+        except Exception as e:
+            print(f"❌ Lỗi khi kiểm tra key qua HTTP: {e}")
+            return web.json_response({'valid': False, 'reason': 'error'}, status=503)
+        return web.json_response(result)
     
-    def get_expired_keys(self, keys_data):
-        """Lấy danh sách key đã hết hạn"""
-        now = datetime.datetime.utcnow()
-        expired_keys = []
-        
-        for key in keys_data:
-            if key.get('expires'):
-                expiry_date = datetime.datetime.fromisoformat(key['expires'].replace('Z', ''))
-                if expiry_date < now:
-                    expired_keys.append(key)
-        
-        return expired_keys
+    async def ready(request):
+        if not manager.ready.is_set():
+            return web.json_response({'ready': False}, status=503)
+        return web.json_response({'ready': True})
+    
+    async def prometheus(request):
+        return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+    
+    async def internal_write(request):
+        """Leader nhận lệnh ghi do follower chuyển tới"""
+        # So sánh thời gian hằng để không lộ secret qua thời gian phản hồi
+        if not REPLICA_SECRET or not hmac.compare_digest(request.headers.get('X-Replica-Secret', '').encode(), REPLICA_SECRET.encode()):
+            return web.json_response({'error': 'forbidden'}, status=403)
+        if manager.forwarding or manager.election is None:
+            return web.json_response({'error': 'Replica này không phải leader'}, status=503)
+        try:
+            payload = loads_json(await request.read())
+            method, op, args = payload['method'], payload.get('op'), payload.get('args') or {}
+            audit_context.set((payload.get('actor'), payload.get('command')))
+            if isinstance(op, str) and op not in WRITE_OPS:
+                raise ValueError(f"op không hợp lệ: {op}")
+            if method == 'submit':
+                result = await manager.submit(op, payload.get('keys'), **args)
+            elif method == 'update_admins':
+                result = sorted(await manager.update_admins(op, **args))
+            elif method == 'remove_expired':
+                result = await manager.remove_expired(payload['expired_keys'])
+            else:
+                raise ValueError(f"method không hợp lệ: {method}")
+        except KeyOpError as e:
+            return web.json_response({'error': str(e)}, status=409)
+        except CommitError as e:
+            return web.json_response({'error': str(e)}, status=503)
+        except (ValueError, KeyError, TypeError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+        return web.Response(body=dumps_json({'result': result}), content_type='application/json')
+    
+    app = web.Application()
+    app.router.add_get('/verify', verify)
+    app.router.add_get('/ready', ready)
+    app.router.add_get('/metrics', prometheus)
+    app.router.add_post('/internal/write', internal_write)
+    return app
+
+def create_backend():
+    """Tạo backend lưu trữ theo STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteBackend(SQLITE_PATH)
+    if GITHUB_SHARDS > 1:
+        return ShardedGitHubBackend(GITHUB_TOKEN, GITHUB_REPO, SHARD_DIR, GITHUB_SHARDS)
+    return GitHubJsonBackend(GITHUB_TOKEN, GITHUB_REPO)
+
+def create_election():
+    """Tạo LeaderElection theo LEADER_LEASE_BACKEND (None = chỉ chạy một replica)"""
+    if LEADER_LEASE_BACKEND == 'file':
+        return LeaderElection(FileLeaseStore(LEADER_LEASE_PATH or 'leader.lock'))
+    if LEADER_LEASE_BACKEND == 'sqlite':
+        return LeaderElection(SQLiteLeaseStore(LEADER_LEASE_PATH or SQLITE_PATH))
+    return None
+
+class KeyCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        # Giống on_message: không chia shard thì chỉ leader xử lý slash command và autocomplete
+        return not (DISCORD_SHARD_COUNT == 1 and interaction.client.key_manager.forwarding)
+
+class KeyBot(commands.Bot):
+    """Bot giữ một KeyManager dùng chung cho cả tiến trình"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key_manager = KeyManager(
+            create_backend(),
+            create_election(),
+            WriteAheadJournal(JOURNAL_PATH) if JOURNAL_PATH else None,
+            AuditLog(AUDIT_DB_PATH) if AUDIT_DB_PATH else None,
+        )
+        self.verify_runner = None
+        self.warm_up_task = None
+    
+    async def setup_hook(self):
+        # Warm-up chạy song song với đăng nhập gateway, lệnh đến trước sẽ chờ key_manager.ready
+        print(f"🔌 Đang khởi tạo backend lưu trữ: {STORAGE_BACKEND}")
+        self.warm_up_task = asyncio.create_task(self.key_manager.warm_up())
+        if VERIFY_PORT:
+            self.verify_runner = web.AppRunner(create_verify_app(self.key_manager), access_log=None)
+            await self.verify_runner.setup()
+            await web.TCPSite(self.verify_runner, VERIFY_HOST, VERIFY_PORT).start()
+            print(f"🌐 Đã mở /verify tại {VERIFY_HOST}:{VERIFY_PORT}")
+        if SLASH_SYNC:
+            try:
+                guild = discord.Object(id=int(SLASH_GUILD_ID)) if SLASH_GUILD_ID else None
+                if guild is not None:
+                    self.tree.copy_global_to(guild=guild)
+                synced = await self.tree.sync(guild=guild)
+                print(f"⌨️ Đã đồng bộ {len(synced)} slash command")
+            except Exception as e:
+                print(f"⚠️ Lỗi khi đồng bộ slash command: {e}")
+    
+    async def on_message(self, message):
+        # Không chia shard thì replica nào cũng nhận cùng một tin nhắn: chỉ leader trả lời
+        if DISCORD_SHARD_COUNT == 1 and self.key_manager.forwarding:
+            return
+        await self.process_commands(message)
+    
+    async def close(self):
+        if self.warm_up_task is not None and not self.warm_up_task.done():
+            self.warm_up_task.cancel()
+        if self.verify_runner is not None:
+            await self.verify_runner.cleanup()
+        await self.key_manager.close()
+        await super().close()
+
+intents = discord.Intents.default()
+intents.message_content = True
+shard_options = {'shard_id': DISCORD_SHARD_ID, 'shard_count': DISCORD_SHARD_COUNT} if DISCORD_SHARD_COUNT > 1 else {}
+bot = KeyBot(command_prefix='!', intents=intents, help_command=None, tree_cls=KeyCommandTree, **shard_options)
 
 @bot.event
 async def on_ready():
@@ -91,21 +2925,82 @@ async def on_ready():
     print(f'👥 Số server: {len(bot.guilds)}')
     print(f'🚄 Đang chạy trên Railway - 24/7!')
     print(f'⏰ Start time: {datetime.datetime.now()}')
+    print(f'🔥 Dữ liệu key: {"đã sẵn sàng" if bot.key_manager.ready.is_set() else "đang warm-up"}')
     
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name="!menu | Railway 24/7"))
 
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.perf_started = time.perf_counter()
+    await defer_interaction(ctx)
+    audit_context.set((ctx.author.id, ctx.command.qualified_name))
+
+@bot.after_invoke
+async def record_command_timer(ctx):
+    if not hasattr(ctx, 'perf_started'):
+        return
+    name = ctx.command.qualified_name
+    metrics.observe('command_seconds', time.perf_counter() - ctx.perf_started, command=name)
+    metrics.inc('commands_total', command=name, status='error' if ctx.command_failed else 'ok')
+
+async def defer_interaction(ctx):
+    """Slash command: báo Discord là bot đang xử lý (hạn 3 giây), kết quả gửi sau bằng followup"""
+    if ctx.interaction is not None and not ctx.interaction.response.is_done():
+        await ctx.defer()
+
 def is_admin():
     """Check xem user có phải admin không"""
     async def predicate(ctx):
-        return ctx.author.id in ADMIN_IDS
+        manager = bot.key_manager
+        # Check chạy trước lệnh và có thể phải chờ warm-up: defer trước để slash command không hết hạn
+        await defer_interaction(ctx)
+        await manager.ready.wait()
+        return ctx.author.id in manager.admins
     return commands.check(predicate)
 
+async def key_autocomplete(interaction, current):
+    """Gợi ý key theo tiền tố từ index trong bộ nhớ, không gọi backend để kịp hạn 3 giây.
+    
+    Ô nhập nhiều key (cách nhau bởi khoảng trắng) thì gợi ý cho key cuối cùng.
+    """
+    with metrics.timer('autocomplete_seconds'):
+        manager = bot.key_manager
+        store = manager.cached_store()
+        if store is None or interaction.user.id not in manager.admins:
+            return []
+        head, _, prefix = current.rpartition(' ')
+        results = store.query(prefix=prefix, limit=25)
+        if not results and prefix != prefix.upper():
+            results = store.query(prefix=prefix.upper(), limit=25)
+        
+        choices = []
+        for key_obj in results:
+            value = f"{head} {key_obj['key']}".strip()
+            if len(value) > 100:
+                continue
+            status = "đã kích hoạt" if key_obj['hwid'] else "chưa kích hoạt"
+            choices.append(app_commands.Choice(name=f"{key_obj['key']} · {key_obj['type']} · {status}", value=value))
+        return choices
+
 # ===============================
 # 🎯 LỆNH TẠO KEY
 # ===============================
 
-@bot.command()
+@write_op
+def add_keys(store, key_objs):
+    """Thêm các key mới, trả về danh sách tên key đã lưu"""
+    names = []
+    for key_obj in key_objs:
+        if key_obj['key'] in store:
+            # Trùng với key vừa được tạo ở lệnh khác trước khi commit
+            key_obj = dict(key_obj, key=KeyManager.generate_keys(1, store)[0])
+        store.add(dict(key_obj))
+        names.append(key_obj['key'])
+    return names
+
+@bot.hybrid_command()
 @is_admin()
+@app_commands.choices(key_type=[app_commands.Choice(name=t, value=t) for t in ("single", "multi", "unlimited")])
 async def taokey(ctx, key_type: str, amount: int = 1, days: int = 30):
     """Tạo key với loại và số lượng tùy chọn"""
     valid_types = ["single", "multi", "unlimited"]
@@ -114,50 +3009,121 @@ async def taokey(ctx, key_type: str, amount: int = 1, days: int = 30):
         await ctx.send(f"❌ Loại key không hợp lệ! Chọn: {', '.join(valid_types)}")
         return
     
-    await ctx.send(f"🔄 Đang tạo {amount} key {key_type}...")
+    if amount < 1 or amount > TAOKEY_MAX_AMOUNT:
+        await ctx.send(f"❌ Số lượng phải từ 1 đến {TAOKEY_MAX_AMOUNT}!")
+        return
+    
+    if ctx.interaction is None:
+        # Slash command đã hiện "đang xử lý" nhờ defer
+        await ctx.send(f"🔄 Đang tạo {amount} key {key_type}...")
     
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
+    manager = bot.key_manager
+    existing = await manager.get_cached_json()
+    expires = manager.calculate_expiry_date(days) if key_type != "unlimited" else None
     
     new_keys = []
-    for i in range(amount):
+    for generated in manager.generate_keys(amount, existing):
         new_key = {
-            "key": manager.generate_key(),
+            "key": generated,
             "hwid": "",
             "type": key_type,
-            "expires": manager.calculate_expiry_date(days) if key_type != "unlimited" else None
+            "expires": expires
         }
         
         if key_type == "unlimited":
             new_key["unlimited"] = True
         
         new_keys.append(new_key)
-        current_data.append(new_key)
     
-    if await manager.update_json(current_data):
-        embed = discord.Embed(title="✅ Tạo Keys Thành Công", color=0x00ff00)
-        embed.add_field(name="Số lượng", value=f"{amount} keys", inline=True)
-        embed.add_field(name="Loại", value=key_type.capitalize(), inline=True)
-        if key_type != "unlimited":
-            embed.add_field(name="Hạn", value=f"{days} ngày", inline=True)
-        
-        keys_list = "\n".join([f"`{key['key']}`" for key in new_keys[:3]])
-        if len(new_keys) > 3:
-            keys_list += f"\n... và {len(new_keys) - 3} keys khác"
-        
-        embed.add_field(name="Keys đã tạo", value=keys_list, inline=False)
-        await ctx.send(embed=embed)
-    else:
-        await ctx.send("❌ Lỗi khi tạo keys!")
-
-# ===============================
-# 🗑️ LỆNH XÓA KEY
-# ===============================
+    try:
+        names = await manager.submit('add_keys', keys=[k['key'] for k in new_keys], key_objs=new_keys)
+    except PartialCommitError as e:
+        # Một phần key đã được lưu: không để người dùng tạo lại cả lô
+        created = [name for name in e.result or () if name in e.written]
+        await ctx.send(
+            f"⚠️ Chỉ lưu được {len(created)}/{amount} key, {amount - len(created)} key chưa được lưu. "
+            f"Đừng chạy lại lệnh cho cả lô!",
+            file=discord.File(io.BytesIO("\n".join(created).encode()), filename="created_keys.txt") if created else None,
+        )
+        return
+    except CommitError:
+        await ctx.send("❌ Lỗi khi tạo keys!")
+        return
+    for new_key, name in zip(new_keys, names):
+        new_key['key'] = name
+    
+    embed = discord.Embed(title="✅ Tạo Keys Thành Công", color=0x00ff00)
+    embed.add_field(name="Số lượng", value=f"{amount} keys", inline=True)
+    embed.add_field(name="Loại", value=key_type.capitalize(), inline=True)
+    if key_type != "unlimited":
+        embed.add_field(name="Hạn", value=f"{days} ngày", inline=True)
+    
+    keys_list = "\n".join([f"`{key['key']}`" for key in new_keys[:3]])
+    if len(new_keys) > 3:
+        keys_list += f"\n... và {len(new_keys) - 3} keys khác (xem file đính kèm)"
+    
+    embed.add_field(name="Keys đã tạo", value=keys_list, inline=False)
+    
+    if len(new_keys) <= 3:
+        await ctx.send(embed=embed)
+        return
+    
+    # Gửi toàn bộ keys dưới dạng file TXT tạo trong bộ nhớ
+    buffer = io.BytesIO()
+    for key in new_keys:
+        buffer.write(key['key'].encode() + b"\n")
+    buffer.seek(0)
+    await ctx.send(embed=embed, file=discord.File(buffer, filename=f"keys_{key_type}_{len(new_keys)}.txt"))
+
+# ===============================
+# 🗑️ LỆNH XÓA KEY
+# ===============================
+
+@write_op
+def delete_keys(store, names):
+    """Xóa các key, trả về (danh sách đã xóa, danh sách không tìm thấy)"""
+    return store.remove_many(names)
+
+async def confirm_delete(ctx, keys):
+    """Hỏi xác nhận trước khi xóa nhiều key, trả về True nếu user react ✅"""
+    embed = discord.Embed(title="⚠️ XÁC NHẬN XÓA NHIỀU KEY", color=0xffa500)
+    embed.add_field(name="Số key sẽ xóa", value=f"**{len(keys)}** keys", inline=False)
+    embed.add_field(name="Danh sách key", value="\n".join([f"`{key}`" for key in keys[:10]]), inline=False)
+    if len(keys) > 10:
+        embed.add_field(name="...", value=f"và {len(keys) - 10} keys khác", inline=False)
+    embed.add_field(name="Xác nhận", value="React với ✅ để xóa, ❌ để hủy", inline=False)
+    
+    confirm_msg = await ctx.send(embed=embed)
+    await confirm_msg.add_reaction("✅")
+    await confirm_msg.add_reaction("❌")
+    
+    def reaction_check(reaction, user):
+        return user == ctx.author and str(reaction.emoji) in ["✅", "❌"] and reaction.message.id == confirm_msg.id
+    
+    try:
+        reaction, user = await bot.wait_for('reaction_add', timeout=30.0, check=reaction_check)
+    except asyncio.TimeoutError:
+        await confirm_msg.delete()
+        await ctx.send("⏰ Hết thời gian xác nhận!")
+        return False
+    
+    if str(reaction.emoji) != "✅":
+        embed_cancel = discord.Embed(title="❌ Đã Hủy", color=0xff0000)
+        embed_cancel.add_field(name="Thao tác", value="Đã hủy xóa key", inline=False)
+        await confirm_msg.edit(embed=embed_cancel)
+        await confirm_msg.clear_reactions()
+        return False
+    
+    await confirm_msg.delete()
+    return True
 
-@bot.command()
+@bot.hybrid_command()
 @is_admin()
-async def xoakey(ctx, *keys):
+@app_commands.autocomplete(keys=key_autocomplete)
+@app_commands.describe(keys="Các key cần xóa, cách nhau bằng khoảng trắng")
+async def xoakey(ctx, *, keys: str = ""):
     """Xóa một hoặc nhiều key khỏi hệ thống"""
+    keys = keys.split()
     if not keys:
         await ctx.send("📝 **Hướng dẫn xóa nhiều key:**\n"
                       "Cách 1: `!xoakey KEY1 KEY2 KEY3` (cách nhau bằng khoảng trắng)\n"
@@ -184,126 +3150,109 @@ async def xoakey(ctx, *keys):
             await ctx.send("⏰ Hết thời gian nhập danh sách key!")
             return
     
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
+    manager = bot.key_manager
+    current_data = await manager.get_cached_json()
     
     if not current_data:
         await ctx.send("📭 Không có key nào trong hệ thống!")
         return
     
-    deleted_keys = []
-    not_found_keys = []
-    new_data = []
-    
-    for key_obj in current_data:
-        if key_obj['key'] in keys:
-            deleted_keys.append(key_obj['key'])
-        else:
-            new_data.append(key_obj)
-    
-    for key in keys:
-        if key not in deleted_keys:
-            not_found_keys.append(key)
+    found_keys = [key for key in dict.fromkeys(keys) if key in current_data]
     
-    if not deleted_keys:
+    if not found_keys:
         await ctx.send("❌ Không tìm thấy key nào để xóa!")
         return
     
-    if len(deleted_keys) > 3:
-        embed = discord.Embed(title="⚠️ XÁC NHẬN XÓA NHIỀU KEY", color=0xffa500)
-        embed.add_field(name="Số key sẽ xóa", value=f"**{len(deleted_keys)}** keys", inline=False)
-        embed.add_field(name="Danh sách key", value="\n".join([f"`{key}`" for key in deleted_keys[:10]]), inline=False)
-        if len(deleted_keys) > 10:
-            embed.add_field(name="...", value=f"và {len(deleted_keys) - 10} keys khác", inline=False)
-        embed.add_field(name="Xác nhận", value="React với ✅ để xóa, ❌ để hủy", inline=False)
-        
-        confirm_msg = await ctx.send(embed=embed)
-        await confirm_msg.add_reaction("✅")
-        await confirm_msg.add_reaction("❌")
-        
-        def reaction_check(reaction, user):
-            return user == ctx.author and str(reaction.emoji) in ["✅", "❌"] and reaction.message.id == confirm_msg.id
-        
-        try:
-            reaction, user = await bot.wait_for('reaction_add', timeout=30.0, check=reaction_check)
-            
-            if str(reaction.emoji) != "✅":
-                embed_cancel = discord.Embed(title="❌ Đã Hủy", color=0xff0000)
-                embed_cancel.add_field(name="Thao tác", value="Đã hủy xóa key", inline=False)
-                await confirm_msg.edit(embed=embed_cancel)
-                await confirm_msg.clear_reactions()
-                return
-            else:
-                await confirm_msg.delete()
-        except asyncio.TimeoutError:
-            await confirm_msg.delete()
-            await ctx.send("⏰ Hết thời gian xác nhận!")
-            return
+    if len(found_keys) > 3 and not await confirm_delete(ctx, found_keys):
+        return
     
-    if await manager.update_json(new_data):
-        embed_success = discord.Embed(title="✅ Xóa Key Thành Công", color=0x00ff00)
-        embed_success.add_field(name="Đã xóa", value=f"**{len(deleted_keys)}** keys", inline=True)
-        
-        if not_found_keys:
-            embed_success.add_field(name="Không tìm thấy", value=f"**{len(not_found_keys)}** keys", inline=True)
-        
-        if deleted_keys:
-            keys_display = "\n".join([f"`{key}`" for key in deleted_keys[:8]])
-            if len(deleted_keys) > 8:
-                keys_display += f"\n... và {len(deleted_keys) - 8} keys khác"
-            embed_success.add_field(name="Keys đã xóa", value=keys_display, inline=False)
-        
-        if not_found_keys:
-            not_found_display = "\n".join([f"`{key}`" for key in not_found_keys[:5]])
-            if len(not_found_keys) > 5:
-                not_found_display += f"\n... và {len(not_found_keys) - 5} keys khác"
-            embed_success.add_field(name="Keys không tồn tại", value=not_found_display, inline=False)
-        
-        await ctx.send(embed=embed_success)
-    else:
+    try:
+        deleted_keys, not_found_keys = await manager.submit('delete_keys', keys=keys, names=keys)
+    except CommitError:
         await ctx.send("❌ Lỗi khi xóa key!")
+        return
+    
+    embed_success = discord.Embed(title="✅ Xóa Key Thành Công", color=0x00ff00)
+    embed_success.add_field(name="Đã xóa", value=f"**{len(deleted_keys)}** keys", inline=True)
+    
+    if not_found_keys:
+        embed_success.add_field(name="Không tìm thấy", value=f"**{len(not_found_keys)}** keys", inline=True)
+    
+    if deleted_keys:
+        keys_display = "\n".join([f"`{key}`" for key in deleted_keys[:8]])
+        if len(deleted_keys) > 8:
+            keys_display += f"\n... và {len(deleted_keys) - 8} keys khác"
+        embed_success.add_field(name="Keys đã xóa", value=keys_display, inline=False)
+    
+    if not_found_keys:
+        not_found_display = "\n".join([f"`{key}`" for key in not_found_keys[:5]])
+        if len(not_found_keys) > 5:
+            not_found_display += f"\n... và {len(not_found_keys) - 5} keys khác"
+        embed_success.add_field(name="Keys không tồn tại", value=not_found_display, inline=False)
+    
+    await ctx.send(embed=embed_success)
 
 # ===============================
 # 🔄 RESET HWID
 # ===============================
 
-@bot.command()
+@write_op
+def reset_hwid(store, key):
+    """Reset HWID của một key single, trả về HWID cũ"""
+    k = store.get(key)
+    if k is None:
+        raise KeyOpError("❌ Key không tồn tại!")
+    
+    if k['type'] != 'single':
+        raise KeyOpError("❌ Chỉ có thể reset HWID cho key single!")
+    
+    old_hwid = k['hwid']
+    store.update(key, hwid="")  # Reset HWID về trống
+    return old_hwid
+
+@bot.hybrid_command(name="resethwid", aliases=["resetHWID"])
 @is_admin()
+@app_commands.autocomplete(key=key_autocomplete)
 async def resetHWID(ctx, key: str):
     """Reset HWID cho key (dùng khi user đổi máy)"""
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
-    
-    key_found = False
-    for k in current_data:
-        if k['key'] == key:
-            if k['type'] != 'single':
-                await ctx.send("❌ Chỉ có thể reset HWID cho key single!")
-                return
-            
-            old_hwid = k['hwid']
-            k['hwid'] = ""  # Reset HWID về trống
-            key_found = True
-            break
+    manager = bot.key_manager
     
-    if not key_found:
-        await ctx.send("❌ Key không tồn tại!")
+    try:
+        old_hwid = await manager.submit('reset_hwid', keys=[key], key=key)
+    except KeyOpError as e:
+        await ctx.send(str(e))
         return
-    
-    if await manager.update_json(current_data):
-        embed = discord.Embed(title="✅ Reset HWID Thành Công", color=0x00ff00)
-        embed.add_field(name="Key", value=f"`{key}`", inline=False)
-        embed.add_field(name="HWID cũ", value=f"`{old_hwid if old_hwid else 'Trống'}`", inline=True)
-        embed.add_field(name="HWID mới", value="`Trống` (chưa kích hoạt)", inline=True)
-        embed.add_field(name="📝 Lưu ý", value="Key đã được reset và có thể kích hoạt lại trên máy mới", inline=False)
-        await ctx.send(embed=embed)
-    else:
+    except CommitError:
         await ctx.send("❌ Lỗi khi reset HWID!")
+        return
+    
+    embed = discord.Embed(title="✅ Reset HWID Thành Công", color=0x00ff00)
+    embed.add_field(name="Key", value=f"`{key}`", inline=False)
+    embed.add_field(name="HWID cũ", value=f"`{old_hwid if old_hwid else 'Trống'}`", inline=True)
+    embed.add_field(name="HWID mới", value="`Trống` (chưa kích hoạt)", inline=True)
+    embed.add_field(name="📝 Lưu ý", value="Key đã được reset và có thể kích hoạt lại trên máy mới", inline=False)
+    await ctx.send(embed=embed)
 
 # ===============================
 # 👥 QUẢN LÝ ADMIN
 # ===============================
 
+@write_op
+def add_admin(admins, user_id):
+    """Thêm user_id vào tập admin"""
+    if user_id in admins:
+        raise KeyOpError("❌ User đã có trong danh sách admin!")
+    admins.add(user_id)
+
+@write_op
+def remove_admin(admins, user_id):
+    """Xóa user_id khỏi tập admin (giữ lại ít nhất một admin)"""
+    if user_id not in admins:
+        raise KeyOpError("❌ User không có trong danh sách admin!")
+    if len(admins) <= 1:
+        raise KeyOpError("❌ Không thể xóa admin cuối cùng!")
+    admins.remove(user_id)
+
 @bot.command()
 @is_admin()
 async def themuser(ctx, user_id: str):
@@ -314,17 +3263,19 @@ async def themuser(ctx, user_id: str):
         await ctx.send("❌ ID user không hợp lệ!")
         return
     
-    if user_id_int in ADMIN_IDS:
-        await ctx.send("❌ User đã có trong danh sách admin!")
+    try:
+        admins = await bot.key_manager.update_admins('add_admin', user_id=user_id_int)
+    except KeyOpError as e:
+        await ctx.send(str(e))
+        return
+    except CommitError:
+        await ctx.send("❌ Lỗi khi lưu danh sách admin!")
         return
-    
-    # Thêm user mới vào ADMIN_IDS
-    ADMIN_IDS.append(user_id_int)
     
     embed = discord.Embed(title="✅ Thêm User Admin Thành Công", color=0x00ff00)
     embed.add_field(name="User ID", value=f"`{user_id_int}`", inline=False)
-    embed.add_field(name="Tổng số admin", value=f"**{len(ADMIN_IDS)}** users", inline=True)
-    embed.add_field(name="📝 Lưu ý", value="Thay đổi này có hiệu lực ngay lập tức", inline=False)
+    embed.add_field(name="Tổng số admin", value=f"**{len(admins)}** users", inline=True)
+    embed.add_field(name="📝 Lưu ý", value="Thay đổi này có hiệu lực ngay lập tức và được lưu lại sau khi restart", inline=False)
     
     await ctx.send(embed=embed)
 
@@ -338,24 +3289,22 @@ async def xoauser(ctx, user_id: str):
         await ctx.send("❌ ID user không hợp lệ!")
         return
     
-    if user_id_int not in ADMIN_IDS:
-        await ctx.send("❌ User không có trong danh sách admin!")
-        return
-    
-    if len(ADMIN_IDS) <= 1:
-        await ctx.send("❌ Không thể xóa admin cuối cùng!")
-        return
-    
     if user_id_int == ctx.author.id:
         await ctx.send("❌ Bạn không thể tự xóa chính mình!")
         return
     
-    # Xóa user khỏi ADMIN_IDS
-    ADMIN_IDS.remove(user_id_int)
+    try:
+        admins = await bot.key_manager.update_admins('remove_admin', user_id=user_id_int)
+    except KeyOpError as e:
+        await ctx.send(str(e))
+        return
+    except CommitError:
+        await ctx.send("❌ Lỗi khi lưu danh sách admin!")
+        return
     
     embed = discord.Embed(title="✅ Xóa User Admin Thành Công", color=0x00ff00)
     embed.add_field(name="User ID", value=f"`{user_id_int}`", inline=False)
-    embed.add_field(name="Tổng số admin", value=f"**{len(ADMIN_IDS)}** users", inline=True)
+    embed.add_field(name="Tổng số admin", value=f"**{len(admins)}** users", inline=True)
     
     await ctx.send(embed=embed)
 
@@ -364,19 +3313,28 @@ async def xoauser(ctx, user_id: str):
 async def danhsachuser(ctx):
     """Hiển thị danh sách tất cả admin"""
     embed = discord.Embed(title="👥 Danh Sách Admin", color=0x7289da)
+    admin_ids = sorted(bot.key_manager.admins)
+    
+    # Lấy từ cache của bot trước, user chưa có trong cache thì fetch đồng thời một lượt
+    users = {user_id: bot.get_user(user_id) for user_id in admin_ids}
+    missing = [user_id for user_id, user in users.items() if user is None]
+    if missing:
+        fetched = await asyncio.gather(*(bot.fetch_user(user_id) for user_id in missing), return_exceptions=True)
+        for user_id, user in zip(missing, fetched):
+            users[user_id] = None if isinstance(user, Exception) else user
     
     user_list = []
-    for user_id in ADMIN_IDS:
-        try:
-            user = await bot.fetch_user(user_id)
-            user_info = f"`{user_id}` - {user.name}#{user.discriminator}"
-            if user_id == ctx.author.id:
-                user_info += " 👈 (Bạn)"
-            user_list.append(user_info)
-        except:
+    for user_id in admin_ids:
+        user = users[user_id]
+        if user is None:
             user_list.append(f"`{user_id}` - Không tìm thấy user")
+            continue
+        user_info = f"`{user_id}` - {user.name}#{user.discriminator}"
+        if user_id == ctx.author.id:
+            user_info += " 👈 (Bạn)"
+        user_list.append(user_info)
     
-    embed.add_field(name="Tổng số admin", value=f"**{len(ADMIN_IDS)}** users", inline=False)
+    embed.add_field(name="Tổng số admin", value=f"**{len(admin_ids)}** users", inline=False)
     embed.add_field(name="Danh sách", value="\n".join(user_list), inline=False)
     
     await ctx.send(embed=embed)
@@ -385,88 +3343,77 @@ async def danhsachuser(ctx):
 # 📅 GIA HẠN KEY
 # ===============================
 
-@bot.command()
+@write_op
+def extend_key(store, key, days):
+    """Gia hạn thêm days ngày cho key, trả về ngày hết hạn mới (ISO)"""
+    k = store.get(key)
+    if k is None:
+        raise KeyOpError("❌ Key không tồn tại!")
+    
+    if k.get('unlimited'):
+        raise KeyOpError("❌ Key unlimited không thể gia hạn!")
+    
+    if not k.get('expires'):
+        raise KeyOpError("❌ Key này không có thời hạn!")
+    
+    # Tính ngày hết hạn mới
+    new_expiry = store.expiry_of(key) + datetime.timedelta(days=days)
+    store.update(key, expires=new_expiry.isoformat())
+    return new_expiry.isoformat()
+
+@bot.hybrid_command()
 @is_admin()
+@app_commands.autocomplete(key=key_autocomplete)
 async def giahankey(ctx, key: str, them_ngay: int):
     """Gia hạn thêm ngày cho key"""
     if them_ngay <= 0:
         await ctx.send("❌ Số ngày gia hạn phải lớn hơn 0!")
         return
     
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
-    
-    key_found = False
-    for k in current_data:
-        if k['key'] == key:
-            if k.get('unlimited'):
-                await ctx.send("❌ Key unlimited không thể gia hạn!")
-                return
-            
-            if not k.get('expires'):
-                await ctx.send("❌ Key này không có thời hạn!")
-                return
-            
-            # Tính ngày hết hạn mới
-            old_expiry = datetime.datetime.fromisoformat(k['expires'].replace('Z', ''))
-            new_expiry = old_expiry + datetime.timedelta(days=them_ngay)
-            k['expires'] = new_expiry.isoformat()
-            
-            days_left = (new_expiry - datetime.datetime.utcnow()).days
-            key_found = True
-            break
+    manager = bot.key_manager
     
-    if not key_found:
-        await ctx.send("❌ Key không tồn tại!")
+    try:
+        new_expiry = parse_expiry(await manager.submit('extend_key', keys=[key], key=key, days=them_ngay))
+    except KeyOpError as e:
+        await ctx.send(str(e))
         return
-    
-    if await manager.update_json(current_data):
-        embed = discord.Embed(title="✅ Gia Hạn Key Thành Công", color=0x00ff00)
-        embed.add_field(name="Key", value=f"`{key}`", inline=False)
-        embed.add_field(name="Thêm ngày", value=f"**+{them_ngay}** ngày", inline=True)
-        embed.add_field(name="Tổng ngày còn lại", value=f"**{days_left}** ngày", inline=True)
-        embed.add_field(name="Hết hạn vào", value=new_expiry.strftime("%d/%m/%Y %H:%M UTC"), inline=False)
-        await ctx.send(embed=embed)
-    else:
+    except CommitError:
         await ctx.send("❌ Lỗi khi gia hạn key!")
+        return
+    
+    days_left = (new_expiry - datetime.datetime.utcnow()).days
+    
+    embed = discord.Embed(title="✅ Gia Hạn Key Thành Công", color=0x00ff00)
+    embed.add_field(name="Key", value=f"`{key}`", inline=False)
+    embed.add_field(name="Thêm ngày", value=f"**+{them_ngay}** ngày", inline=True)
+    embed.add_field(name="Tổng ngày còn lại", value=f"**{days_left}** ngày", inline=True)
+    embed.add_field(name="Hết hạn vào", value=new_expiry.strftime("%d/%m/%Y %H:%M UTC"), inline=False)
+    await ctx.send(embed=embed)
 
 # ===============================
 # 🗑️ XÓA KEY HẾT HẠN
 # ===============================
 
-@bot.command()
+@bot.hybrid_command()
 @is_admin()
 async def xoakeyhethan(ctx):
     """Xóa tất cả key đã hết hạn"""
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
+    manager = bot.key_manager
+    current_data = await manager.get_cached_json()
     
     if not current_data:
         await ctx.send("📭 Không có key nào trong hệ thống!")
         return
     
-    expired_keys = manager.get_expired_keys(current_data)
+    expired_keys = current_data.expired()
     
     if not expired_keys:
         await ctx.send("✅ Không có key nào hết hạn!")
         return
     
-    new_data = []
-    expired_count = 0
-    
-    for key in current_data:
-        if key.get('expires'):
-            expiry_date = datetime.datetime.fromisoformat(key['expires'].replace('Z', ''))
-            if expiry_date >= datetime.datetime.utcnow():
-                new_data.append(key)
-            else:
-                expired_count += 1
-        else:
-            new_data.append(key)
-    
     embed = discord.Embed(title="⚠️ XÓA KEY HẾT HẠN", color=0xffa500)
-    embed.add_field(name="Số key sẽ xóa", value=f"**{expired_count}** keys", inline=False)
-    embed.add_field(name="Số key sẽ giữ lại", value=f"**{len(new_data)}** keys", inline=False)
+    embed.add_field(name="Số key sẽ xóa", value=f"**{len(expired_keys)}** keys", inline=False)
+    embed.add_field(name="Số key sẽ giữ lại", value=f"**{len(current_data) - len(expired_keys)}** keys", inline=False)
     
     expired_list = "\n".join([f"`{key['key']}` - {key['type']}" for key in expired_keys[:5]])
     if len(expired_keys) > 5:
@@ -486,14 +3433,19 @@ async def xoakeyhethan(ctx):
         reaction, user = await bot.wait_for('reaction_add', timeout=30.0, check=check)
         
         if str(reaction.emoji) == "✅":
-            if await manager.update_json(new_data):
-                embed_success = discord.Embed(title="✅ Xóa Key Hết Hạn Thành Công", color=0x00ff00)
-                embed_success.add_field(name="Đã xóa", value=f"**{expired_count}** keys hết hạn", inline=True)
-                embed_success.add_field(name="Còn lại", value=f"**{len(new_data)}** keys", inline=True)
-                await confirm_msg.edit(embed=embed_success)
-                await confirm_msg.clear_reactions()
-            else:
+            try:
+                expired_count = await manager.remove_expired(expired_keys)
+            except Exception as e:
+                print(f"❌ Lỗi khi xóa key hết hạn: {e}")
                 await ctx.send("❌ Lỗi khi xóa key hết hạn!")
+                return
+            
+            remaining = len(await manager.get_cached_json())
+            embed_success = discord.Embed(title="✅ Xóa Key Hết Hạn Thành Công", color=0x00ff00)
+            embed_success.add_field(name="Đã xóa", value=f"**{expired_count}** keys hết hạn", inline=True)
+            embed_success.add_field(name="Còn lại", value=f"**{remaining}** keys", inline=True)
+            await confirm_msg.edit(embed=embed_success)
+            await confirm_msg.clear_reactions()
         else:
             embed_cancel = discord.Embed(title="❌ Đã Hủy", color=0xff0000)
             embed_cancel.add_field(name="Thao tác", value="Đã hủy xóa key hết hạn", inline=False)
@@ -510,143 +3462,630 @@ async def xoakeyhethan(ctx):
 # 🔑 KÍCH HOẠT KEY
 # ===============================
 
-@bot.command()
+@write_op
+def activate_key(store, key, hwid):
+    """Gắn HWID cho một key single"""
+    k = store.get(key)
+    if k is None:
+        raise KeyOpError("❌ Key không tồn tại!")
+    
+    if k['type'] != 'single':
+        raise KeyOpError("❌ Key này không phải loại single!")
+    
+    store.update(key, hwid=hwid)
+
+@bot.hybrid_command()
 @is_admin()
+@app_commands.autocomplete(key=key_autocomplete)
 async def kichhoat(ctx, key: str, hwid: str):
     """Kích hoạt key single với HWID"""
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
-    
-    key_found = False
-    for k in current_data:
-        if k['key'] == key:
-            if k['type'] != 'single':
-                await ctx.send("❌ Key này không phải loại single!")
-                return
-            
-            k['hwid'] = hwid
-            key_found = True
-            break
+    manager = bot.key_manager
+    
+    try:
+        await manager.submit('activate_key', keys=[key], key=key, hwid=hwid)
+    except KeyOpError as e:
+        await ctx.send(str(e))
+        return
+    except CommitError:
+        await ctx.send("❌ Lỗi khi kích hoạt key!")
+        return
+    
+    embed = discord.Embed(title="✅ Kích Hoạt Thành Công", color=0x00ff00)
+    embed.add_field(name="Key", value=f"`{key}`", inline=False)
+    embed.add_field(name="HWID", value=f"`{hwid}`", inline=False)
+    await ctx.send(embed=embed)
+
+# ===============================
+# 📁 LỆNH HÀNG LOẠT BẰNG FILE
+# ===============================
+
+async def iter_bulk_rows(attachment):
+    """Đọc file đính kèm theo từng dòng (không tải cả file), trả về (số dòng, các cột)"""
+    async with aiohttp.ClientSession(timeout=GITHUB_TIMEOUT) as session:
+        async with session.get(attachment.url) as resp:
+            resp.raise_for_status()
+            line_no = 0
+            async for raw in resp.content:
+                line_no += 1
+                line = raw.decode('utf-8-sig', errors='replace').strip()
+                if not line or line.startswith('#'):
+                    continue
+                cells = [cell.strip('"\'') for cell in re.split(r'[,;\t ]+', line) if cell.strip('"\'')]
+                if cells:
+                    yield line_no, cells
+
+async def read_bulk_file(ctx, columns, usage):
+    """Đọc file TXT/CSV đính kèm lệnh.
+    
+    Mỗi dòng: key và ít nhất (columns - 1) cột tiếp theo. Trả về (dict key -> các cột còn lại,
+    kết quả lỗi cho các dòng sai) hoặc None nếu không đọc được (đã báo cho user).
+    """
+    if not ctx.message.attachments:
+        await ctx.send(f"📎 Hãy đính kèm file TXT/CSV (mỗi dòng một key) khi gõ lệnh:\n{usage}")
+        return None
+    
+    attachment = ctx.message.attachments[0]
+    if not attachment.filename.lower().endswith(('.txt', '.csv')):
+        await ctx.send("❌ Chỉ hỗ trợ file .txt hoặc .csv!")
+        return None
+    if attachment.size > BULK_MAX_BYTES:
+        await ctx.send(f"❌ File quá lớn! Tối đa {BULK_MAX_BYTES // (1024 * 1024)} MB")
+        return None
+    
+    entries, invalid = {}, []
+    try:
+        async for line_no, cells in iter_bulk_rows(attachment):
+            if line_no == 1 and cells[0].lower() in ('key', 'keys'):
+                continue
+            if len(cells) < columns:
+                invalid.append((cells[0], False, f"Dòng {line_no}: thiếu cột"))
+                continue
+            entries[cells[0]] = cells[1:]
+            if len(entries) > BULK_MAX_KEYS:
+                await ctx.send(f"❌ File có quá nhiều key! Tối đa {BULK_MAX_KEYS} keys")
+                return None
+    except Exception as e:
+        print(f"❌ Lỗi khi đọc file hàng loạt: {e}")
+        await ctx.send("❌ Không đọc được file!")
+        return None
     
-    if not key_found:
-        await ctx.send("❌ Key không tồn tại!")
+    if not entries:
+        await ctx.send("❌ Không có key nào trong file!")
+        return None
+    return entries, invalid
+
+async def send_bulk_report(ctx, title, results):
+    """Gửi embed tóm tắt và file CSV kết quả từng key"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["key", "ket_qua", "chi_tiet"])
+    failed = []
+    for key, ok, detail in results:
+        writer.writerow([key, "OK" if ok else "LOI", detail])
+        if not ok:
+            failed.append((key, detail))
+    
+    embed = discord.Embed(title=title, color=0x00ff00 if not failed else 0xffa500)
+    embed.add_field(name="Thành công", value=f"**{len(results) - len(failed)}** keys", inline=True)
+    embed.add_field(name="Lỗi", value=f"**{len(failed)}** keys", inline=True)
+    if failed:
+        failed_display = "\n".join(f"`{key}` - {detail}" for key, detail in failed[:5])
+        if len(failed) > 5:
+            failed_display += f"\n... và {len(failed) - 5} keys khác (xem file)"
+        embed.add_field(name="Một số lỗi", value=failed_display, inline=False)
+    
+    report = discord.File(io.BytesIO(buffer.getvalue().encode('utf-8-sig')), filename="ket-qua.csv")
+    await ctx.send(embed=embed, file=report)
+
+@write_op
+def delete_key_list(store, names):
+    """Xóa các key, trả về (key, thành công, ghi chú) cho báo cáo"""
+    deleted, _ = store.remove_many(names)
+    # Key lặp lại trong file: chỉ lần đầu được tính là đã xóa
+    pending = set(deleted)
+    delete_results = []
+    for key in names:
+        if key in pending:
+            pending.discard(key)
+            delete_results.append((key, True, "Đã xóa"))
+        else:
+            delete_results.append((key, False, "Key không tồn tại"))
+    return delete_results
+
+@write_op
+def extend_key_list(store, entries, days):
+    """Gia hạn từng key, entries: key -> các cột còn lại (cột đầu là số ngày riêng, nếu có)"""
+    extend_results, updates = [], {}
+    for key, extra in entries.items():
+        key_days = days
+        if extra:
+            try:
+                key_days = int(extra[0])
+            except ValueError:
+                key_days = 0
+        k = store.get(key)
+        if key_days <= 0:
+            extend_results.append((key, False, "Số ngày không hợp lệ"))
+        elif k is None:
+            extend_results.append((key, False, "Key không tồn tại"))
+        elif k.get('unlimited'):
+            extend_results.append((key, False, "Key unlimited không thể gia hạn"))
+        elif not k.get('expires'):
+            extend_results.append((key, False, "Key không có thời hạn"))
+        else:
+            new_expiry = store.expiry_of(key) + datetime.timedelta(days=key_days)
+            updates[key] = {'expires': new_expiry.isoformat()}
+            extend_results.append((key, True, f"+{key_days} ngày, hết hạn {new_expiry.strftime('%d/%m/%Y %H:%M')} UTC"))
+    store.update_many(updates)
+    return extend_results
+
+@write_op
+def reset_hwid_list(store, names):
+    """Reset HWID từng key single, trả về (key, thành công, ghi chú) cho báo cáo"""
+    reset_results, updates = [], {}
+    for key in names:
+        k = store.get(key)
+        if k is None:
+            reset_results.append((key, False, "Key không tồn tại"))
+        elif k['type'] != 'single':
+            reset_results.append((key, False, "Không phải key single"))
+        else:
+            old_hwid = "" if key in updates else k['hwid']
+            updates[key] = {'hwid': ""}
+            reset_results.append((key, True, f"HWID cũ: {old_hwid or 'Trống'}"))
+    store.update_many(updates)
+    return reset_results
+
+@write_op
+def activate_key_list(store, entries):
+    """Kích hoạt từng key single, entries: key -> [HWID, ...]"""
+    activate_results, updates = [], {}
+    for key, extra in entries.items():
+        hwid = extra[0]
+        k = store.get(key)
+        if k is None:
+            activate_results.append((key, False, "Key không tồn tại"))
+        elif k['type'] != 'single':
+            activate_results.append((key, False, "Không phải key single"))
+        else:
+            updates[key] = {'hwid': hwid}
+            activate_results.append((key, True, f"HWID: {hwid}"))
+    store.update_many(updates)
+    return activate_results
+
+@bot.command()
+@is_admin()
+async def xoakeyfile(ctx):
+    """Xóa hàng loạt key từ file TXT/CSV đính kèm"""
+    parsed = await read_bulk_file(ctx, 1, "`!xoakeyfile` + file (mỗi dòng: `KEY`)")
+    if parsed is None:
         return
+    entries, results = parsed
+    keys = list(entries)
     
-    if await manager.update_json(current_data):
-        embed = discord.Embed(title="✅ Kích Hoạt Thành Công", color=0x00ff00)
-        embed.add_field(name="Key", value=f"`{key}`", inline=False)
-        embed.add_field(name="HWID", value=f"`{hwid}`", inline=False)
-        await ctx.send(embed=embed)
-    else:
+    if not await confirm_delete(ctx, keys):
+        return
+    
+    try:
+        results += await bot.key_manager.submit('delete_key_list', keys=keys, names=keys)
+    except CommitError:
+        await ctx.send("❌ Lỗi khi xóa key!")
+        return
+    await send_bulk_report(ctx, "🗑️ Kết Quả Xóa Key Hàng Loạt", results)
+
+@bot.command()
+@is_admin()
+async def giahankeyfile(ctx, them_ngay: int):
+    """Gia hạn hàng loạt key từ file (mỗi dòng có thể ghi số ngày riêng)"""
+    if them_ngay <= 0:
+        await ctx.send("❌ Số ngày gia hạn phải lớn hơn 0!")
+        return
+    
+    parsed = await read_bulk_file(ctx, 1, "`!giahankeyfile <số_ngày>` + file (mỗi dòng: `KEY` hoặc `KEY,số_ngày`)")
+    if parsed is None:
+        return
+    entries, results = parsed
+    
+    try:
+        results += await bot.key_manager.submit('extend_key_list', keys=list(entries), entries=entries, days=them_ngay)
+    except CommitError:
+        await ctx.send("❌ Lỗi khi gia hạn key!")
+        return
+    await send_bulk_report(ctx, "📅 Kết Quả Gia Hạn Key Hàng Loạt", results)
+
+@bot.command()
+@is_admin()
+async def resethwidfile(ctx):
+    """Reset HWID hàng loạt key single từ file"""
+    parsed = await read_bulk_file(ctx, 1, "`!resethwidfile` + file (mỗi dòng: `KEY`)")
+    if parsed is None:
+        return
+    entries, results = parsed
+    
+    try:
+        results += await bot.key_manager.submit('reset_hwid_list', keys=list(entries), names=list(entries))
+    except CommitError:
+        await ctx.send("❌ Lỗi khi reset HWID!")
+        return
+    await send_bulk_report(ctx, "🔄 Kết Quả Reset HWID Hàng Loạt", results)
+
+@bot.command()
+@is_admin()
+async def kichhoatfile(ctx):
+    """Kích hoạt hàng loạt key single từ file KEY,HWID"""
+    parsed = await read_bulk_file(ctx, 2, "`!kichhoatfile` + file (mỗi dòng: `KEY,HWID`)")
+    if parsed is None:
+        return
+    entries, results = parsed
+    
+    try:
+        results += await bot.key_manager.submit('activate_key_list', keys=list(entries), entries=entries)
+    except CommitError:
         await ctx.send("❌ Lỗi khi kích hoạt key!")
+        return
+    await send_bulk_report(ctx, "🔑 Kết Quả Kích Hoạt Key Hàng Loạt", results)
 
 # ===============================
 # 📊 DANH SÁCH & THỐNG KÊ
 # ===============================
 
-@bot.command()
+KEY_LIST_PAGE_SIZE = 10
+
+def describe_key(store, key, now):
+    """Mô tả loại, trạng thái kích hoạt và hạn sử dụng của key cho embed"""
+    status = "✅ Đã kích hoạt" if key['hwid'] else "⏳ Chưa kích hoạt"
+    
+    if key.get('unlimited'):
+        expiry_info = "♾️ Vĩnh viễn"
+    elif key.get('expires'):
+        # Key có thể đã bị xóa khỏi store sau khi danh sách được lấy
+        days_left = ((store.expiry_of(key['key']) or parse_expiry(key['expires'])) - now).days
+        if days_left > 0:
+            expiry_info = f"🟢 {days_left} ngày"
+        else:
+            expiry_info = "🔴 Hết hạn"
+    else:
+        expiry_info = "❓ Không xác định"
+    
+    return f"**Loại:** {key['type']}\n**Trạng thái:** {status}\n**Hạn sử dụng:** {expiry_info}"
+
+class JumpToPageModal(discord.ui.Modal, title="Đi tới trang"):
+    page = discord.ui.TextInput(label="Số trang", max_length=6)
+    
+    def __init__(self, key_view):
+        super().__init__()
+        self.key_view = key_view
+    
+    async def on_submit(self, interaction):
+        try:
+            page = int(self.page.value)
+        except ValueError:
+            await interaction.response.send_message("❌ Số trang không hợp lệ!", ephemeral=True)
+            return
+        if page < 1 or page > self.key_view.total_pages:
+            await interaction.response.send_message(f"❌ Trang không hợp lệ! Chọn từ 1 đến {self.key_view.total_pages}", ephemeral=True)
+            return
+        self.key_view.page = page
+        await self.key_view.refresh(interaction)
+
+class KeyListView(discord.ui.View):
+    """Phân trang danh sách key trên một snapshot, sửa trực tiếp tin nhắn thay vì gửi lại"""
+    def __init__(self, store, author_id, page=1):
+        super().__init__(timeout=120)
+        # store là cache của backend, có thể bị sửa tại chỗ sau mỗi lệnh ghi:
+        # giữ danh sách key, key hết hạn và thống kê riêng để trang, bộ lọc và
+        # footer luôn khớp nhau. store chỉ còn dùng để lấy nhanh ngày hết hạn đã parse
+        self.store = store
+        self.snapshot = list(store)
+        now = datetime.datetime.utcnow()
+        self.expired = store.expired(now)
+        self.stats = store.stats(now)
+        self.author_id = author_id
+        self.page = page
+        self.message = None
+        self.key_type = None
+        self.status = None
+        # None = toàn bộ snapshot, còn lại là kết quả lọc
+        self.keys = None
+        self._update_buttons()
+    
+    @property
+    def total_count(self):
+        return len(self.snapshot) if self.keys is None else len(self.keys)
+    
+    @property
+    def total_pages(self):
+        return max(1, (self.total_count + KEY_LIST_PAGE_SIZE - 1) // KEY_LIST_PAGE_SIZE)
+    
+    def _apply_filters(self):
+        """Lọc lại danh sách key theo loại/trạng thái (chỉ trên snapshot)"""
+        if self.key_type is None and self.status is None:
+            self.keys = None
+        elif self.status == 'expired':
+            self.keys = [k for k in self.expired if self.key_type is None or k['type'] == self.key_type]
+        else:
+            activated = {'activated': True, 'unactivated': False}.get(self.status)
+            self.keys = [k for k in self.snapshot
+                         if (self.key_type is None or k['type'] == self.key_type)
+                         and (activated is None or bool(k['hwid']) == activated)]
+        self.page = 1
+    
+    def _update_buttons(self):
+        self.first_page.disabled = self.prev_page.disabled = self.page <= 1
+        self.next_page.disabled = self.last_page.disabled = self.page >= self.total_pages
+    
+    def build_embed(self):
+        start_idx = (self.page - 1) * KEY_LIST_PAGE_SIZE
+        end_idx = start_idx + KEY_LIST_PAGE_SIZE
+        page_data = (self.snapshot if self.keys is None else self.keys)[start_idx:end_idx]
+        
+        embed = discord.Embed(
+            title=f"📋 DANH SÁCH TẤT CẢ KEYS (Trang {self.page}/{self.total_pages})", 
+            color=0x0099ff
+        )
+        
+        if not page_data:
+            embed.description = "📭 Không có key nào khớp bộ lọc!"
+        
+        now = datetime.datetime.utcnow()
+        for i, key in enumerate(page_data, start=start_idx + 1):
+            embed.add_field(name=f"#{i} - `{key['key']}`", value=describe_key(self.store, key, now), inline=False)
+        
+        stats = self.stats
+        embed.set_footer(text=f"🔐 Single: {stats['single']} | 👥 Multi: {stats['multi']} | ♾️ Unlimited: {stats['unlimited']} | 🔴 Hết hạn: {stats['expired']} | 📊 Tổng: {stats['total']}")
+        return embed
+    
+    async def refresh(self, interaction):
+        self._update_buttons()
+        await interaction.response.edit_message(embed=self.build_embed(), view=self)
+    
+    async def interaction_check(self, interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("❌ Chỉ người dùng lệnh mới được chuyển trang!", ephemeral=True)
+            return False
+        return True
+    
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+    
+    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary, row=0)
+    async def first_page(self, interaction, button):
+        self.page = 1
+        await self.refresh(interaction)
+    
+    @discord.ui.button(emoji="⬅️", style=discord.ButtonStyle.primary, row=0)
+    async def prev_page(self, interaction, button):
+        self.page = max(1, self.page - 1)
+        await self.refresh(interaction)
+    
+    @discord.ui.button(label="Đi tới trang", style=discord.ButtonStyle.secondary, row=0)
+    async def jump_page(self, interaction, button):
+        await interaction.response.send_modal(JumpToPageModal(self))
+    
+    @discord.ui.button(emoji="➡️", style=discord.ButtonStyle.primary, row=0)
+    async def next_page(self, interaction, button):
+        self.page = min(self.total_pages, self.page + 1)
+        await self.refresh(interaction)
+    
+    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary, row=0)
+    async def last_page(self, interaction, button):
+        self.page = self.total_pages
+        await self.refresh(interaction)
+    
+    @discord.ui.select(placeholder="Lọc theo loại", row=1, options=[
+        discord.SelectOption(label="Tất cả loại", value="all", emoji="📊"),
+        discord.SelectOption(label="Single", value="single", emoji="🔐"),
+        discord.SelectOption(label="Multi", value="multi", emoji="👥"),
+        discord.SelectOption(label="Unlimited", value="unlimited", emoji="♾️"),
+    ])
+    async def filter_type(self, interaction, select):
+        self.key_type = None if select.values[0] == "all" else select.values[0]
+        self._apply_filters()
+        await self.refresh(interaction)
+    
+    @discord.ui.select(placeholder="Lọc theo trạng thái", row=2, options=[
+        discord.SelectOption(label="Tất cả trạng thái", value="all", emoji="📊"),
+        discord.SelectOption(label="Đã kích hoạt", value="activated", emoji="✅"),
+        discord.SelectOption(label="Chưa kích hoạt", value="unactivated", emoji="⏳"),
+        discord.SelectOption(label="Hết hạn", value="expired", emoji="🔴"),
+    ])
+    async def filter_status(self, interaction, select):
+        self.status = None if select.values[0] == "all" else select.values[0]
+        self._apply_filters()
+        await self.refresh(interaction)
+
+@bot.hybrid_command()
 @is_admin()
 async def danhsachkey(ctx, page: int = 1):
     """Hiển thị danh sách FULL tất cả keys (phân trang)"""
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
+    manager = bot.key_manager
+    current_data = await manager.get_cached_json()
     
     if not current_data:
         await ctx.send("📭 Không có key nào trong hệ thống!")
         return
     
-    items_per_page = 10
-    total_pages = (len(current_data) + items_per_page - 1) // items_per_page
+    view = KeyListView(current_data, ctx.author.id, page)
+    if page < 1 or page > view.total_pages:
+        await ctx.send(f"❌ Trang không hợp lệ! Chọn từ 1 đến {view.total_pages}")
+        return
     
-    if page < 1 or page > total_pages:
-        await ctx.send(f"❌ Trang không hợp lệ! Chọn từ 1 đến {total_pages}")
+    view.message = await ctx.send(embed=view.build_embed(), view=view)
+
+@bot.hybrid_command()
+@is_admin()
+@app_commands.describe(terms="tiền_tố loai: hwid: kichhoat: conhan: hethan thangnay")
+async def timkey(ctx, *, terms: str = ""):
+    """Tìm key theo tiền tố, loại, HWID, trạng thái và hạn sử dụng (dùng index)"""
+    terms = terms.split()
+    if not terms:
+        await ctx.send("📝 **Cách dùng:** `!timkey [tiền_tố] [loai:single|multi|unlimited] [hwid:HWID] "
+                       "[kichhoat:co|khong] [conhan:số_ngày] [hethan] [thangnay]`\n"
+                       "Ví dụ: `!timkey loai:multi kichhoat:co thangnay` - key multi đã kích hoạt hết hạn trong tháng này")
         return
     
-    start_idx = (page - 1) * items_per_page
-    end_idx = start_idx + items_per_page
-    page_data = current_data[start_idx:end_idx]
+    now = datetime.datetime.utcnow()
+    filters = {}
+    for term in terms:
+        name, _, value = term.partition(':')
+        name = name.lower()
+        if name == 'loai' and value:
+            filters['key_type'] = value.lower()
+        elif name == 'hwid' and value:
+            filters['hwid'] = value
+        elif name == 'kichhoat' and value.lower() in ('co', 'khong'):
+            filters['activated'] = value.lower() == 'co'
+        elif name == 'conhan' and value.isdigit():
+            filters['expires_after'], filters['expires_before'] = now, now + datetime.timedelta(days=int(value))
+        elif term.lower() == 'hethan':
+            filters.pop('expires_after', None)
+            filters['expires_before'] = now
+        elif term.lower() == 'thangnay':
+            next_month = (now.replace(day=1) + datetime.timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            filters['expires_after'], filters['expires_before'] = now, next_month
+        elif not value:
+            filters['prefix'] = term
+        else:
+            await ctx.send(f"❌ Điều kiện không hợp lệ: `{term}`")
+            return
     
-    embed = discord.Embed(
-        title=f"📋 DANH SÁCH TẤT CẢ KEYS (Trang {page}/{total_pages})", 
-        color=0x0099ff
-    )
+    current_data = await bot.key_manager.get_cached_json()
+    results = current_data.query(**filters)
     
-    for i, key in enumerate(page_data, start=start_idx + 1):
-        status = "✅ Đã kích hoạt" if key['hwid'] else "⏳ Chưa kích hoạt"
-        
-        if key.get('unlimited'):
-            expiry_info = "♾️ Vĩnh viễn"
-        elif key.get('expires'):
-            expiry_date = datetime.datetime.fromisoformat(key['expires'].replace('Z', ''))
-            days_left = (expiry_date - datetime.datetime.utcnow()).days
-            if days_left > 0:
-                expiry_info = f"🟢 {days_left} ngày"
-            else:
-                expiry_info = "🔴 Hết hạn"
-        else:
-            expiry_info = "❓ Không xác định"
-        
-        embed.add_field(
-            name=f"#{i} - `{key['key']}`",
-            value=f"**Loại:** {key['type']}\n**Trạng thái:** {status}\n**Hạn sử dụng:** {expiry_info}",
-            inline=False
-        )
+    if not results:
+        await ctx.send("🔍 Không tìm thấy key nào khớp điều kiện!")
+        return
     
-    single_keys = [k for k in current_data if k['type'] == 'single']
-    multi_keys = [k for k in current_data if k['type'] == 'multi']
-    unlimited_keys = [k for k in current_data if k.get('unlimited')]
-    expired_keys = manager.get_expired_keys(current_data)
+    embed = discord.Embed(title=f"🔍 Kết Quả Tìm Key ({len(results)} keys)", color=0x0099ff)
+    for key in results[:KEY_LIST_PAGE_SIZE]:
+        embed.add_field(name=f"`{key['key']}`", value=describe_key(current_data, key, now), inline=False)
     
-    embed.set_footer(text=f"🔐 Single: {len(single_keys)} | 👥 Multi: {len(multi_keys)} | ♾️ Unlimited: {len(unlimited_keys)} | 🔴 Hết hạn: {len(expired_keys)} | 📊 Tổng: {len(current_data)}")
+    if len(results) <= KEY_LIST_PAGE_SIZE:
+        await ctx.send(embed=embed)
+        return
     
-    message = await ctx.send(embed=embed)
+    # Nhiều kết quả: ghi từng dòng vào file CSV đính kèm
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(["key", "type", "hwid", "expires"])
+    for key in results:
+        writer.writerow([key['key'], key['type'], key['hwid'], key.get('expires') or ""])
+    text.flush()
+    text.detach()
+    buffer.seek(0)
     
-    if total_pages > 1:
-        await message.add_reaction("⬅️")
-        await message.add_reaction("➡️")
-        
-        def check(reaction, user):
-            return (user == ctx.author and 
-                   str(reaction.emoji) in ["⬅️", "➡️"] and 
-                   reaction.message.id == message.id)
-        
-        try:
-            reaction, user = await bot.wait_for('reaction_add', timeout=30.0, check=check)
-            
-            if str(reaction.emoji) == "➡️" and page < total_pages:
-                await message.delete()
-                await danhsachkey(ctx, page + 1)
-            elif str(reaction.emoji) == "⬅️" and page > 1:
-                await message.delete()
-                await danhsachkey(ctx, page - 1)
-            else:
-                await message.clear_reactions()
-                
-        except asyncio.TimeoutError:
-            await message.clear_reactions()
+    embed.set_footer(text=f"Hiển thị {KEY_LIST_PAGE_SIZE}/{len(results)} keys, xem đầy đủ trong file đính kèm")
+    await ctx.send(embed=embed, file=discord.File(buffer, filename="tim-kiem.csv"))
 
-@bot.command()
+AUDIT_PAGE_SIZE = 10
+
+def describe_audit_event(event):
+    """Mô tả một sự kiện lịch sử: tạo/xóa key hoặc các trường trước -> sau"""
+    before, after = event['before'], event['after']
+    if before is None:
+        return "🆕 Tạo key"
+    if after is None:
+        return "🗑️ Xóa key"
+    lines = [f"`{field}`: `{before.get(field) or 'Trống'}` → `{after.get(field) or 'Trống'}`" for field in after]
+    return "\n".join(lines) or "Không đổi"
+
+@bot.hybrid_command()
+@is_admin()
+@app_commands.autocomplete(target=key_autocomplete)
+async def lichsu(ctx, target: str, so_dong: int = AUDIT_PAGE_SIZE):
+    """Xem lịch sử thay đổi của một key hoặc của một admin"""
+    audit = bot.key_manager.audit
+    if audit is None:
+        await ctx.send("❌ Lịch sử thay đổi đang tắt (AUDIT_DB_PATH trống)!")
+        return
+    limit = max(1, min(so_dong, 25))
+    
+    # Mention hoặc user:<ID> -> xem theo người thực hiện, còn lại là key
+    match = re.fullmatch(r'<@!?(\d+)>|user:(\d+)', target)
+    started = time.perf_counter()
+    if match:
+        actor = int(match.group(1) or match.group(2))
+        events = await audit.by_actor(actor, limit)
+        title = f"📜 Lịch Sử Thao Tác Của {actor}"
+    else:
+        events = await audit.history(target, limit)
+        title = f"📜 Lịch Sử Key {target}"
+    elapsed = (time.perf_counter() - started) * 1000
+    
+    if not events:
+        await ctx.send("📭 Không có lịch sử thay đổi nào!")
+        return
+    
+    embed = discord.Embed(title=title, color=0x0099ff)
+    for event in events:
+        when = datetime.datetime.utcfromtimestamp(event['ts']).strftime('%d/%m/%Y %H:%M:%S')
+        who = f"<@{event['actor']}>" if event['actor'] else "Hệ thống"
+        header = f"`{event['key']}` - " if match else ""
+        embed.add_field(
+            name=f"{when} UTC · !{event['command'] or '?'}",
+            value=f"{header}{who}\n{describe_audit_event(event)}"[:1024],
+            inline=False,
+        )
+    embed.set_footer(text=f"{len(events)} sự kiện mới nhất · truy vấn {elapsed:.1f} ms")
+    await ctx.send(embed=embed)
+
+@bot.hybrid_command()
 @is_admin()
 async def thongke(ctx):
     """Chỉ hiển thị số lượng từng loại key (đơn giản)"""
-    manager = KeyManager(GITHUB_TOKEN, GITHUB_REPO)
-    current_data = await manager.get_current_json()
+    manager = bot.key_manager
+    current_data = await manager.get_cached_json()
     
     if not current_data:
         await ctx.send("📭 Không có key nào trong hệ thống!")
         return
     
-    single_keys = [k for k in current_data if k['type'] == 'single']
-    multi_keys = [k for k in current_data if k['type'] == 'multi']
-    unlimited_keys = [k for k in current_data if k.get('unlimited')]
-    expired_keys = manager.get_expired_keys(current_data)
+    stats = current_data.stats()
     
     embed = discord.Embed(title="📈 Thống Kê Loại Key", color=0x00ff00)
-    embed.add_field(name="🔐 Single Keys", value=f"**{len(single_keys)}** keys", inline=True)
-    embed.add_field(name="👥 Multi Keys", value=f"**{len(multi_keys)}** keys", inline=True)
-    embed.add_field(name="♾️ Unlimited Keys", value=f"**{len(unlimited_keys)}** keys", inline=True)
-    embed.add_field(name="🔴 Key Hết Hạn", value=f"**{len(expired_keys)}** keys", inline=True)
-    embed.add_field(name="📊 Tổng Cộng", value=f"**{len(current_data)}** keys", inline=True)
+    embed.add_field(name="🔐 Single Keys", value=f"**{stats['single']}** keys", inline=True)
+    embed.add_field(name="👥 Multi Keys", value=f"**{stats['multi']}** keys", inline=True)
+    embed.add_field(name="♾️ Unlimited Keys", value=f"**{stats['unlimited']}** keys", inline=True)
+    embed.add_field(name="🟢 Đã Kích Hoạt", value=f"**{stats['activated']}** keys", inline=True)
+    embed.add_field(name="⚪ Chưa Kích Hoạt", value=f"**{stats['unactivated']}** keys", inline=True)
+    embed.add_field(name="🔴 Key Hết Hạn", value=f"**{stats['expired']}** keys", inline=True)
+    embed.add_field(name="📊 Tổng Cộng", value=f"**{stats['total']}** keys", inline=True)
+    
+    await ctx.send(embed=embed)
+
+@bot.command()
+@is_admin()
+async def perf(ctx):
+    """Xem số liệu hiệu năng: thời gian lệnh, storage, GitHub API"""
+    def fmt_ms(seconds):
+        return f"{seconds * 1000:.0f}"
+    
+    def table(rows, label):
+        if not rows:
+            return "Chưa có dữ liệu"
+        rows = sorted(rows, key=lambda row: row[2][0.95], reverse=True)[:10]
+        return "\n".join(
+            f"`{labels.get(label, '-')}` x{count}: p50 {fmt_ms(q[0.5])} | p95 {fmt_ms(q[0.95])} | p99 {fmt_ms(q[0.99])} ms"
+            for labels, count, q in rows
+        )
+    
+    embed = discord.Embed(title="⏱️ Hiệu Năng Bot", color=0x7289da)
+    embed.add_field(name="🤖 Lệnh", value=table(metrics.summary('command_seconds'), 'command'), inline=False)
+    embed.add_field(name="💾 Storage", value=table(metrics.summary('storage_seconds'), 'op'), inline=False)
+    embed.add_field(name="🐙 GitHub API", value=table(metrics.summary('github_request_seconds'), 'method'), inline=False)
+    
+    remaining = metrics.gauges.get(('github_ratelimit_remaining', ()))
+    embed.add_field(name="📨 Request GitHub", value=f"**{metrics.total('github_requests_total'):g}**", inline=True)
+    embed.add_field(name="📥 Nhận", value=f"**{metrics.total('github_bytes_total', direction='in') / 1024:.0f}** KB", inline=True)
+    embed.add_field(name="📤 Gửi", value=f"**{metrics.total('github_bytes_total', direction='out') / 1024:.0f}** KB", inline=True)
+    embed.add_field(name="🚦 Rate limit còn", value=f"**{remaining:g}**" if remaining is not None else "Chưa rõ", inline=True)
     
     await ctx.send(embed=embed)
 
@@ -684,6 +4123,17 @@ async def menu(ctx):
             inline=False
         )
         
+        embed1.add_field(
+            name="📁 **LỆNH HÀNG LOẠT (đính kèm file TXT/CSV):**",
+            value=(
+                "`!xoakeyfile` - Xóa các key trong file\n"
+                "`!giahankeyfile <số_ngày>` - Gia hạn (dòng `KEY` hoặc `KEY,số_ngày`)\n"
+                "`!resethwidfile` - Reset HWID các key single trong file\n"
+                "`!kichhoatfile` - Kích hoạt theo dòng `KEY,HWID`"
+            ),
+            inline=False
+        )
+        
         await ctx.send(embed=embed1)
         
         # Embed 2: Lệnh admin và thống kê
@@ -707,7 +4157,10 @@ async def menu(ctx):
             name="📊 **LỆNH XEM THỐNG KÊ:**",
             value=(
                 "`!danhsachkey [page]` - Xem danh sách FULL keys (phân trang)\n"
+                "`!timkey [tiền_tố] [loai:] [hwid:] [kichhoat:] [conhan:] [hethan] [thangnay]` - Tìm key\n"
+                "`!lichsu <key | @user> [số_dòng]` - Lịch sử thay đổi\n"
                 "`!thongke` - Xem nhanh số lượng từng loại key\n"
+                "`!perf` - Xem số liệu hiệu năng (lệnh, storage, GitHub)\n"
                 "`!menu` - Hiển thị menu này\n"
                 "`!help` - Hiển thị hướng dẫn sử dụng"
             ),
@@ -726,6 +4179,15 @@ async def menu(ctx):
             inline=False
         )
         
+        embed2.add_field(
+            name="⌨️ **SLASH COMMAND:**",
+            value=(
+                "`/taokey` `/xoakey` `/resethwid` `/giahankey` `/kichhoat` `/xoakeyhethan`\n"
+                "`/danhsachkey` `/timkey` `/lichsu` `/thongke` - gợi ý key khi gõ"
+            ),
+            inline=False
+        )
+        
         embed2.set_footer(text="🤖 Bot Quản Lý Key - GitHub Integration | 🚄 Railway 24/7")
         await ctx.send(embed=embed2)
         
@@ -796,7 +4258,10 @@ async def help(ctx):
 
 @bot.event
 async def on_command_error(ctx, error):
-    if isinstance(error, commands.CheckFailure):
+    if isinstance(error, commands.HybridCommandError):
+        # Lỗi khi chạy dạng slash command được bọc lại
+        error = error.original
+    if isinstance(error, (commands.CheckFailure, app_commands.CheckFailure)):
         await ctx.send("❌ Bạn không có quyền sử dụng lệnh này!")
     elif isinstance(error, commands.MissingRequiredArgument):
         await ctx.send("❌ Thiếu tham số! Sử dụng `!menu` để xem hướng dẫn.")
@@ -810,6 +4275,8 @@ async def on_command_error(ctx, error):
 # 🚀 CHẠY BOT
 # ===============================
 if __name__ == "__main__":
+    if not check_env():
+        exit(1)
     print("🚀 Đang khởi động Bot Discord...")
     print("🚄 Kích hoạt chế độ Railway 24/7...")
     try:
@@ -0,0 +1,99 @@
+"""Kiểm tra journal của KeyManager: lệnh ghi đã trả lời không bị mất khi backend đổi giữa chừng.
+
+Chạy: python -m unittest test_journal (hoặc python -m pytest test_journal.py)
+"""
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+os.environ.setdefault('GITHUB_TOKEN', 'test')
+
+import main  # noqa: E402
+
+class MemoryBackend(main.KeyBackend):
+    """Backend trong bộ nhớ: mỗi lần ghi tạo KeyStore mới như GitHubJsonBackend"""
+    def __init__(self, keys=()):
+        self.store = main.KeyStore(keys)
+
+    def cached(self):
+        return self.store
+
+    async def load(self):
+        return self.store
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def load_admins(self):
+        return None
+
+    async def apply(self, ops, keys=None):
+        store = self.store.copy()
+        results = main.run_ops(store, ops)
+        self.store = store
+        return results
+
+class JournalOverlayTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.backend = MemoryBackend([
+            {"key": "A", "hwid": "", "type": "single", "expires": "2099-01-01T00:00:00"},
+            {"key": "B", "hwid": "", "type": "single", "expires": "2099-01-01T00:00:00"},
+        ])
+        self.journal = main.WriteAheadJournal(os.path.join(self.tmp.name, 'journal.log'))
+        self.manager = main.KeyManager(self.backend, journal=self.journal)
+        await self.manager.warm_up()
+
+    async def asyncTearDown(self):
+        await self.manager.close()
+        self.tmp.cleanup()
+
+    def slow_append(self, delay=0.2):
+        append_sync = self.journal._append_sync
+        def append(line):
+            time.sleep(delay)
+            append_sync(line)
+        self.journal._append_sync = append
+
+    async def test_write_survives_flush_and_read_during_fsync(self):
+        self.slow_append()
+        write = asyncio.create_task(self.manager.submit('activate_key', keys=['A'], key='A', hwid='H1'))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.manager.cached_store().get('A')['hwid'], '', "lệnh đọc thấy dữ liệu chưa fsync")
+        # Backend đổi (như một lần flush/tải lại GitHub) và có lệnh đọc trong lúc đang fsync
+        self.backend.store = self.backend.store.copy()
+        seen = (await self.manager.get_cached_json()).get('A')['hwid']
+        await write
+
+        self.assertEqual(seen, 'H1')
+        self.assertEqual((await self.manager.get_cached_json()).get('A')['hwid'], 'H1')
+        self.assertTrue((await self.manager.verify('A', 'H1'))['valid'])
+
+        # Lệnh ghi sau lên cùng key phải giữ HWID đã kích hoạt khi flush
+        await self.manager.submit('extend_key', keys=['A'], key='A', days=1)
+        while self.journal.pending:
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.backend.store.get('A')['hwid'], 'H1')
+
+    async def test_failed_append_leaves_overlay_unchanged(self):
+        def failing_append(line):
+            raise OSError("disk full")
+        self.journal._append_sync = failing_append
+        snapshot = list(self.manager.cached_store())
+        
+        with self.assertRaises(main.CommitError):
+            await self.manager.submit('delete_keys', keys=['A'], names=['A'])
+        with self.assertRaises(main.CommitError):
+            await self.manager.submit('activate_key', keys=['B'], key='B', hwid='H2')
+        
+        store = await self.manager.get_cached_json()
+        self.assertEqual([k['key'] for k in store], ['A', 'B'])
+        self.assertEqual(store.to_list(), self.backend.store.to_list())
+        self.assertEqual(store.query(hwid=''), [store.get('A'), store.get('B')])
+        # Danh sách đã lấy trước lệnh ghi không thấy thay đổi đã hủy
+        self.assertEqual([k['hwid'] for k in snapshot], ['', ''])
+
+if __name__ == "__main__":
+    unittest.main()